@@ -0,0 +1,93 @@
+"""Checks a bot's webhook server locally with a fake Telegram sender.
+
+Usage: python check_webhook.py [bot script, default 9jacashflow.py]
+
+Starts the bot's webhook server on a free local port (with TLS if
+TELEGRAM_WEBHOOK_CERT is set) and sends it requests the way Telegram would.
+Received updates are only collected here, nothing is stored or posted.
+"""
+import os
+import sys
+import asyncio
+import ssl
+import importlib.util
+import httpx
+
+WEBHOOK_PATH = "/telegram-webhook"
+
+def load_bot(path):
+    """Runs a bot script's setup (loading its env file) and returns the social_bot module it configured."""
+    spec = importlib.util.spec_from_file_location("webhook_bot", path)
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+    return script.social_bot
+
+def fake_update(update_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "webhook check",
+            "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": False, "first_name": "Check"},
+        },
+    }
+
+class RawResponse:
+    def __init__(self, status_line):
+        self.status_code = int(status_line.split()[1])
+
+async def oversized_request(port, use_tls):
+    """Announces a body above WEBHOOK_MAX_BODY_BYTES; the server must refuse it before reading it."""
+    context = None
+    if use_tls:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, ssl=context)
+    writer.write(f"POST {WEBHOOK_PATH} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {50 * 1024 * 1024}\r\n\r\n".encode("ascii"))
+    await writer.drain()
+    status_line = (await reader.readline()).decode("latin-1")
+    writer.close()
+    return RawResponse(status_line)
+
+async def check(bot):
+    received = []
+    bot.record_received_updates = lambda updates: updates
+    bot.dispatch_update = lambda update, bot_instance: received.append(update.update_id)
+    bot.TELEGRAM_WEBHOOK_LISTEN, bot.TELEGRAM_WEBHOOK_PORT = "127.0.0.1", 0
+
+    server = await bot.start_webhook_server(None, WEBHOOK_PATH)
+    port = server.sockets[0].getsockname()[1]
+    scheme = "https" if bot.TELEGRAM_WEBHOOK_CERT else "http"
+    url = f"{scheme}://127.0.0.1:{port}{WEBHOOK_PATH}"
+    secret = {"X-Telegram-Bot-Api-Secret-Token": bot.TELEGRAM_WEBHOOK_SECRET}
+    failures = []
+
+    def expect(name, response, status):
+        ok = response.status_code == status
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: {response.status_code} (expected {status})")
+        if not ok:
+            failures.append(name)
+
+    async with server:
+        # Self-signed certificates cannot be verified here; Telegram checks them itself
+        async with httpx.AsyncClient(verify=False) as client:
+            # Two updates on one keep-alive connection, like Telegram sends them
+            expect("update with secret", await client.post(url, json=fake_update(1), headers=secret), 200)
+            expect("second update, same connection", await client.post(url, json=fake_update(2), headers=secret), 200)
+            expect("wrong secret", await client.post(url, json=fake_update(3), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}), 403)
+            expect("missing secret", await client.post(url, json=fake_update(4)), 403)
+            expect("unknown path", await client.post(url.replace(WEBHOOK_PATH, "/other"), json=fake_update(5), headers=secret), 404)
+            expect("GET request", await client.get(url, headers=secret), 404)
+            expect("broken JSON", await client.post(url, content=b"{", headers=secret), 400)
+        expect("oversized body", await oversized_request(port, scheme == "https"), 413)
+
+    if received != [1, 2]:
+        print(f"FAIL dispatched updates: {received} (expected [1, 2])")
+        failures.append("dispatch")
+    else:
+        print("ok   dispatched updates: [1, 2]")
+    return not failures
+
+if __name__ == "__main__":
+    script = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "9jacashflow.py")
+    sys.exit(0 if asyncio.run(check(load_bot(script))) else 1)
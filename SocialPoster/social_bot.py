@@ -0,0 +1,2429 @@
+"""The Telegram-to-social-media posting bot shared by 9jacashflow.py, coinoyo2.py and filtang2.py.
+
+Each of those scripts only loads its own env file and then calls run(), so
+everything here reads its settings from the environment at import time.
+"""
+import os
+import sys
+import asyncio
+import logging
+import base64
+import hashlib
+import io
+import tempfile
+import time
+import json
+import math
+import random
+import re
+import hmac
+import secrets
+import sqlite3
+import ssl
+from urllib.parse import urlsplit, quote, quote_plus
+import mimetypes
+import httpx
+import requests
+from urllib3.exceptions import NewConnectionError
+import tweepy
+import telegram
+from telegram.request import HTTPXRequest
+from PIL import Image
+import cloudinary
+import cloudinary.uploader
+import collections
+import contextvars
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import h2 # noqa: F401 -- httpx only speaks HTTP/2 when the h2 package is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# --- Global Configuration from Environment Variables ---
+# (loaded from the bot's env file by the script that imports this module)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Add this line to silence httpx's INFO logs
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+logger = logging.getLogger(__name__)
+
+# Twitter (V2 for posting, V1.1 for media upload)
+TWITTER_CLIENT_ID = os.getenv("TWITTER_CLIENT_ID")
+TWITTER_CLIENT_SECRET = os.getenv("TWITTER_CLIENT_SECRET")
+TWITTER_ACCESS_TOKEN = os.getenv("TWITTER_ACCESS_TOKEN")
+TWITTER_REFRESH_TOKEN = os.getenv("TWITTER_REFRESH_TOKEN")
+TWITTER_API_KEY_V1 = os.getenv("TWITTER_API_KEY_V1")
+TWITTER_API_SECRET_V1 = os.getenv("TWITTER_API_SECRET_V1")
+TWITTER_ACCESS_TOKEN_V1 = os.getenv("TWITTER_ACCESS_TOKEN_V1")
+TWITTER_ACCESS_TOKEN_SECRET_V1 = os.getenv("TWITTER_ACCESS_TOKEN_SECRET_V1")
+TWITTER_UPLOAD_URL = os.getenv("TWITTER_UPLOAD_URL", "https://upload.twitter.com/1.1/media/upload.json")
+# Upload media in chunks with the async httpx client; tweepy's media_upload (in a thread) is only the fallback
+TWITTER_ASYNC_UPLOADS = os.getenv("TWITTER_ASYNC_UPLOADS", "true").lower() in ("1", "true", "yes")
+TWITTER_UPLOAD_CHUNK_SIZE = min(int(os.getenv("TWITTER_UPLOAD_CHUNK_KB", "1024")), 5 * 1024) * 1024 # APPEND takes at most 5 MB
+
+# Telegram
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_CHANNEL_ID = os.getenv("TELEGRAM_CHANNEL_ID")
+TELEGRAM_USER_IDS_RAW = os.getenv("TELEGRAM_USER_IDS", "")
+# Convert the comma-separated string of IDs into a list of integers
+AUTHORIZED_USER_IDS = [int(uid.strip()) for uid in TELEGRAM_USER_IDS_RAW.split(',') if uid.strip().isdigit()]
+if not AUTHORIZED_USER_IDS:
+    logger.warning("⚠️ No authorized Telegram user IDs are set. The bot will not respond to any messages.")
+else:
+    logger.info("✅ Authorized Telegram User IDs: %s", AUTHORIZED_USER_IDS)
+
+# Telegram webhook mode (optional). When TELEGRAM_WEBHOOK_URL is set the bot
+# receives updates pushed by Telegram instead of long polling get_updates.
+# Telegram only delivers to HTTPS URLs on port 443, 80, 88 or 8443: either set
+# TELEGRAM_WEBHOOK_CERT (and TELEGRAM_WEBHOOK_KEY, unless the key is in the
+# same PEM file) so the bot serves TLS itself, or leave them unset and put a
+# TLS-terminating reverse proxy in front of the listen port.
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+TELEGRAM_WEBHOOK_LISTEN = os.getenv("TELEGRAM_WEBHOOK_LISTEN", "0.0.0.0")
+TELEGRAM_WEBHOOK_PORT = int(os.getenv("TELEGRAM_WEBHOOK_PORT", "8443"))
+TELEGRAM_WEBHOOK_CERT = os.getenv("TELEGRAM_WEBHOOK_CERT")
+TELEGRAM_WEBHOOK_KEY = os.getenv("TELEGRAM_WEBHOOK_KEY")
+# Upload the certificate with set_webhook so Telegram trusts a self-signed one
+TELEGRAM_WEBHOOK_SELF_SIGNED = os.getenv("TELEGRAM_WEBHOOK_SELF_SIGNED", "false").lower() in ("1", "true", "yes")
+WEBHOOK_MAX_BODY_BYTES = 1024 * 1024 # Telegram updates are small; anything bigger is rejected
+
+# Instagram (and Facebook Page)
+IG_ACCESS_TOKEN = os.getenv("IG_ACCESS_TOKEN")
+IG_PAGE_ID = os.getenv("IG_PAGE_ID")
+IG_ACCOUNT_ID = os.getenv("IG_ACCOUNT_ID")
+FB_PAGE_ID = os.getenv("FB_PAGE_ID")
+FB_PAGE_ACCESS_TOKEN = os.getenv("FB_PAGE_ACCESS_TOKEN")
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v19.0")
+
+# Cloudinary configuration
+CLOUDINARY_CLOUD_NAME = os.getenv("CLOUDINARY_CLOUD_NAME")
+CLOUDINARY_API_KEY = os.getenv("CLOUDINARY_API_KEY")
+CLOUDINARY_API_SECRET = os.getenv("CLOUDINARY_API_SECRET")
+CLOUDINARY_API_URL = os.getenv("CLOUDINARY_API_URL", "https://api.cloudinary.com/v1_1")
+# Upload with the async httpx client; the Cloudinary SDK (in a thread) is only the fallback
+CLOUDINARY_ASYNC_UPLOADS = os.getenv("CLOUDINARY_ASYNC_UPLOADS", "true").lower() in ("1", "true", "yes")
+
+# Global instances (to avoid re-initialization)
+if all([CLOUDINARY_CLOUD_NAME, CLOUDINARY_API_KEY, CLOUDINARY_API_SECRET]):
+    cloudinary.config(
+        cloud_name=CLOUDINARY_CLOUD_NAME,
+        api_key=CLOUDINARY_API_KEY,
+        api_secret=CLOUDINARY_API_SECRET
+    )
+    logger.info("☁️ Cloudinary configured.")
+else:
+    logger.warning("⚠️ Cloudinary credentials not fully set. Image uploads will be skipped for Instagram/Facebook.")
+
+# --- In-memory media ---
+# Photos are downloaded once into memory and every platform reads from that
+# buffer. Files bigger than this are spooled to a private temp file instead.
+MEDIA_SPOOL_THRESHOLD = int(os.getenv("MEDIA_SPOOL_THRESHOLD", str(8 * 1024 * 1024)))
+
+# --- Cloudinary upload cache ---
+# Maps the SHA-256 of an image to its Cloudinary URL so re-posting the same
+# image (e.g. after a partial failure) skips the upload. Stored in the state DB.
+MEDIA_CACHE_TTL_SECONDS = int(os.getenv("MEDIA_CACHE_TTL_DAYS", "30")) * 24 * 3600
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_MB", "2048")) * 1024 * 1024 # Total size of the images remembered
+media_cache_stats = collections.Counter() # "hits" / "misses" / "shared" (joined an upload in flight) since startup
+cloudinary_uploads_in_flight = {} # sha256 -> asyncio.Task, so one image is never uploaded twice at once
+
+# --- Platform image renditions ---
+# Each platform gets its own JPEG encode of a photo: scaled to the largest size
+# the platform displays, progressive, without metadata, and within its limits.
+# The original is used instead whenever it fits and is smaller. Instagram only
+# accepts feed photos between 0.8 and 1.91 (width / height), so those are
+# padded (or cropped) to the nearest legal ratio.
+PLATFORM_IMAGE_LIMITS = {
+    "twitter": {"max_side": 2048, "max_bytes": 5 * 1024 * 1024, "quality": 85},
+    "facebook": {"max_side": 2048, "max_bytes": 4 * 1024 * 1024, "quality": 85},
+    "instagram": {"min_ratio": 0.8, "max_ratio": 1.91, "min_side": 320, "max_side": 1440, "max_bytes": 8 * 1024 * 1024, "quality": 90},
+}
+# When off, only photos that break a platform's limits are re-encoded
+OPTIMIZE_RENDITIONS = os.getenv("OPTIMIZE_RENDITIONS", "true").lower() in ("1", "true", "yes")
+IMAGE_FIT_MODE = os.getenv("IMAGE_FIT_MODE", "pad").lower() # "pad" keeps the whole photo, "crop" trims the long side
+IMAGE_PAD_COLOR = os.getenv("IMAGE_PAD_COLOR", "#ffffff")
+RENDITION_CACHE_SIZE = int(os.getenv("RENDITION_CACHE_SIZE", "64"))
+rendition_cache = collections.OrderedDict() # (sha256, platform) -> TelegramMedia (None: use the original), least recently used first
+rendition_stats = collections.Counter() # "original_bytes" / "rendition_bytes" handed to platforms since startup
+
+# --- Shared HTTP clients ---
+# One long-lived, pooled client per upstream host so repeated posts reuse warm
+# connections instead of paying a TCP+TLS handshake every time.
+HTTP_POOL_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=300)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+GRAPH_MAX_CONCURRENT_REQUESTS = int(os.getenv("GRAPH_MAX_CONCURRENT_REQUESTS", "5")) # Per album/carousel
+# Send Facebook albums and Instagram carousels as a single Graph API batch request
+GRAPH_BATCH_REQUESTS = os.getenv("GRAPH_BATCH_REQUESTS", "true").lower() in ("1", "true", "yes")
+GRAPH_BATCH_LIMIT = 50 # Most operations the Graph API accepts in one batch
+GRAPH_BATCH_REFERENCE = re.compile(r"\{result=[^}]+\}") # JSONPath reference to an earlier operation's result
+graph_client = None # httpx.AsyncClient for the Graph API (Facebook + Instagram), opened in main()
+cloudinary_client = None # httpx.AsyncClient for Cloudinary uploads, opened in main()
+twitter_upload_client = None # httpx.AsyncClient for Twitter media uploads, opened in main()
+twitter_clients = {} # (consumer key, consumer secret, token, token secret) -> (tweepy.Client, tweepy.API)
+
+# --- Blocking work executors ---
+# Blocking SDK calls each get their own thread pool, so a slow Twitter API
+# cannot starve Cloudinary uploads. CPU-bound image work runs in a pool of
+# processes so PIL never blocks the event loop or holds the GIL. Sizes are
+# the number of workers per pool.
+EXECUTOR_SIZES = {
+    "twitter": int(os.getenv("TWITTER_EXECUTOR_WORKERS", "4")),
+    "cloudinary": int(os.getenv("CLOUDINARY_EXECUTOR_WORKERS", "4")),
+    "image": int(os.getenv("IMAGE_EXECUTOR_WORKERS", str(min(4, os.cpu_count() or 1)))),
+}
+PROCESS_POOLS = {"image"}
+executors = {} # name -> ThreadPoolExecutor (ProcessPoolExecutor for PROCESS_POOLS), opened in main()
+executor_stats = {name: collections.Counter() for name in EXECUTOR_SIZES} # queued / peak_queued / calls / wait_ms / max_wait_ms
+executor_stats_lock = threading.Lock()
+
+# --- Retry policy ---
+# Transient platform errors (5xx, rate limits, network trouble) are retried
+# in place with capped exponential backoff and full jitter, honouring any
+# wait the platform asks for. Anything still failing is left to the outbox.
+# Calls that publish a post are only retried when they cannot have created
+# it: rate limits, and connections that failed before the request was sent.
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0 # Longer requested waits (e.g. a far-away rate-limit reset) are left to the outbox
+GRAPH_RATE_LIMIT_ERROR_CODES = {4, 17, 32, 341, 613} # App/user/page rate limits; the call was refused
+GRAPH_TRANSIENT_ERROR_CODES = {1, 2} | GRAPH_RATE_LIMIT_ERROR_CODES # Plus unknown/service errors
+TWITTER_MEDIA_ID_TTL_SECONDS = 20 * 3600 # Twitter media IDs can be attached for 24 hours after upload
+# Set by fan_out for each platform post; with_retries marks it once a publish call goes out
+publish_attempt = contextvars.ContextVar("publish_attempt", default=None)
+
+# --- Rate governor ---
+# A token bucket per platform account paces posts at the sustainable rate:
+# (posts, window in seconds). The usage platforms report in headers and
+# rate-limit errors tighten it further. Posts that would wait longer than
+# RATE_MAX_WAIT_SECONDS are postponed through the outbox so other jobs go first.
+RATE_LIMITS = {
+    "twitter": (int(os.getenv("TWITTER_POSTS_PER_15_MIN", "50")), 15 * 60),
+    "facebook": (int(os.getenv("FACEBOOK_POSTS_PER_HOUR", "60")), 3600),
+    "instagram": (int(os.getenv("INSTAGRAM_POSTS_PER_DAY", "25")), 24 * 3600), # API-published posts per 24h
+    "telegram": (20, 60), # Bot messages per minute to one channel
+}
+RATE_MAX_WAIT_SECONDS = int(os.getenv("RATE_MAX_WAIT_SECONDS", "30"))
+GRAPH_USAGE_THROTTLE_PERCENT = 90 # Above this share of a Graph quota, posts only go out as tokens refill
+rate_governors = {} # (platform, account) -> RateGovernor
+
+# --- Update offset / dedupe store ---
+# SQLite file (next to the bot script by default) that remembers the update
+# offset, updates that were received but not finished yet, and which
+# updates/albums were already posted, so a restart resumes where the bot
+# stopped instead of replaying or dropping posts.
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", os.path.splitext(os.path.abspath(sys.argv[0]))[0] + "_state.db")
+STATE_RETENTION_SECONDS = 7 * 24 * 3600 # How long processed update/album IDs are remembered
+state_db = None
+
+# --- Global variables for media group handling ---
+media_group_messages = collections.defaultdict(list)
+media_group_update_ids = collections.defaultdict(list)
+last_message_time = {}
+media_group_timers = {} # media_group_id -> asyncio.TimerHandle that flushes the group
+flushed_media_groups = {} # media_group_id -> time of the last item, kept briefly to spot late items
+# Longest time to wait after the latest item of a group, until an item
+# arriving after its group was sealed shows that albums need longer
+MEDIA_GROUP_TIMEOUT = float(os.getenv("MEDIA_GROUP_TIMEOUT", "2"))
+MEDIA_GROUP_MAX_TIMEOUT = float(os.getenv("MEDIA_GROUP_MAX_TIMEOUT", "10")) # Late items never raise it past this
+MEDIA_GROUP_LATE_MARGIN = 1.25 # After a late item, wait this many times its gap
+# Shortest quiet period that seals a group. It stays above one get_updates
+# round trip, so an album split across two polls is never sealed in between.
+MEDIA_GROUP_MIN_TIMEOUT = float(os.getenv("MEDIA_GROUP_MIN_TIMEOUT", "1.5"))
+MEDIA_GROUP_BATCH_GAP = 0.05 # Items handled closer together than this came in one delivery batch
+MEDIA_GROUP_GAP_FACTOR = 3 # Quiet period = this many times the typical gap between album items
+media_group_gap_estimate = None # Learned gap between consecutive album items, in seconds
+media_group_timeout_ceiling = MEDIA_GROUP_TIMEOUT # Raised by late items, see record_media_group_gap
+# Album items start downloading and uploading as soon as they arrive; the
+# results wait here (by file_id) until the sealed album is posted.
+SPECULATIVE_UPLOADS = os.getenv("SPECULATIVE_UPLOADS", "true").lower() in ("1", "true", "yes")
+SPECULATIVE_TTL_SECONDS = 600 # Unclaimed early uploads are dropped after this long
+speculative_pipelines = {} # file_id -> PhotoPipeline
+
+# --- Update dispatching / outbox ---
+# Incoming posts are written to an outbox table in the state database and
+# posted by this many workers at the same time, while ingestion keeps draining
+# Telegram. Platforms that fail are retried with a growing delay.
+MAX_CONCURRENT_UPDATES = max(1, int(os.getenv("MAX_CONCURRENT_UPDATES", "4")))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_BASE_DELAY = 15 # Seconds before the first retry, doubled on every further attempt
+OUTBOX_RETRY_MAX_DELAY = 600
+PLATFORMS = ("twitter", "telegram", "facebook", "instagram")
+FANOUT_DEADLINE_SECONDS = int(os.getenv("FANOUT_DEADLINE_SECONDS", "180")) # Platforms still posting after this are retried later
+outbox_wakeup = None # asyncio.Event set whenever a job is added to the outbox
+
+# --- Update State Store ---
+
+def open_state_db():
+    """Opens (and creates if needed) the SQLite state database in WAL mode."""
+    global state_db
+    state_db = sqlite3.connect(STATE_DB_PATH)
+    state_db.execute("PRAGMA journal_mode=WAL")
+    state_db.execute("PRAGMA synchronous=NORMAL")
+    state_db.executescript("""
+        CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS pending_updates (update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, received_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS processed_updates (update_id INTEGER PRIMARY KEY, processed_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS processed_media_groups (media_group_id TEXT PRIMARY KEY, processed_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS outbox_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_key TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            platform_state TEXT NOT NULL DEFAULT '{}',
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS outbox_jobs_due ON outbox_jobs (status, next_attempt_at);
+        CREATE TABLE IF NOT EXISTS media_cache (
+            sha256 TEXT PRIMARY KEY,
+            secure_url TEXT NOT NULL,
+            public_id TEXT,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        );
+    """)
+    cutoff = time.time() - STATE_RETENTION_SECONDS
+    with state_db:
+        state_db.execute("DELETE FROM processed_updates WHERE processed_at < ?", (cutoff,))
+        state_db.execute("DELETE FROM processed_media_groups WHERE processed_at < ?", (cutoff,))
+        state_db.execute("DELETE FROM outbox_jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,))
+        evict_media_cache()
+        # Jobs that were running when the previous run stopped are picked up again
+        interrupted = state_db.execute("UPDATE outbox_jobs SET status = 'pending' WHERE status = 'running'").rowcount
+    if interrupted:
+        logger.info("♻️ Re-queued %d interrupted outbox job(s).", interrupted)
+    logger.info("💾 Update state stored in %s", STATE_DB_PATH)
+
+def load_update_offset():
+    """Returns the get_updates offset saved by the previous run (0 if none)."""
+    row = state_db.execute("SELECT value FROM bot_state WHERE key = 'update_offset'").fetchone()
+    return int(row[0]) if row else 0
+
+def record_received_updates(updates: list):
+    """Saves newly received updates as pending and advances the stored offset.
+
+    This runs before the updates are acknowledged to Telegram, so an update is
+    always either pending here or still on Telegram's side. Returns only the
+    updates that were not seen before.
+    """
+    new_updates = []
+    with state_db:
+        for update in updates:
+            seen = state_db.execute(
+                "SELECT 1 FROM processed_updates WHERE update_id = ? UNION ALL SELECT 1 FROM pending_updates WHERE update_id = ?",
+                (update.update_id, update.update_id)
+            ).fetchone()
+            if seen:
+                logger.info("🔁 Skipping update %d, it was already received.", update.update_id)
+                continue
+            state_db.execute(
+                "INSERT INTO pending_updates (update_id, payload, received_at) VALUES (?, ?, ?)",
+                (update.update_id, json.dumps(update.to_dict()), time.time())
+            )
+            new_updates.append(update)
+        if updates:
+            state_db.execute(
+                "INSERT INTO bot_state (key, value) VALUES ('update_offset', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+                (str(updates[-1].update_id + 1),)
+            )
+    return new_updates
+
+def load_pending_updates(bot_instance: telegram.Bot):
+    """Returns the updates a previous run received but did not finish."""
+    rows = state_db.execute("SELECT payload FROM pending_updates ORDER BY update_id").fetchall()
+    return [telegram.Update.de_json(json.loads(payload), bot_instance) for (payload,) in rows]
+
+def mark_updates_processed(update_ids: list, media_group_id: str = None):
+    """Moves finished updates (and their album) from pending to processed.
+
+    Does not commit; call it inside a `with state_db:` block.
+    """
+    now = time.time()
+    for update_id in update_ids:
+        state_db.execute("DELETE FROM pending_updates WHERE update_id = ?", (update_id,))
+        state_db.execute("INSERT OR IGNORE INTO processed_updates (update_id, processed_at) VALUES (?, ?)", (update_id, now))
+    if media_group_id:
+        state_db.execute("INSERT OR IGNORE INTO processed_media_groups (media_group_id, processed_at) VALUES (?, ?)", (media_group_id, now))
+
+def is_media_group_processed(media_group_id: str):
+    row = state_db.execute("SELECT 1 FROM processed_media_groups WHERE media_group_id = ?", (media_group_id,)).fetchone()
+    return row is not None
+
+# --- Media Cache Store ---
+
+def lookup_media_cache(sha256: str):
+    """Returns the cached Cloudinary URL for an image hash, or None."""
+    row = state_db.execute(
+        "SELECT secure_url FROM media_cache WHERE sha256 = ? AND created_at >= ?",
+        (sha256, time.time() - MEDIA_CACHE_TTL_SECONDS)
+    ).fetchone()
+    if row is None:
+        return None
+    with state_db:
+        state_db.execute("UPDATE media_cache SET last_used_at = ? WHERE sha256 = ?", (time.time(), sha256))
+    return row[0]
+
+def store_media_cache(sha256: str, secure_url: str, public_id: str, size: int):
+    now = time.time()
+    with state_db:
+        state_db.execute(
+            "INSERT OR REPLACE INTO media_cache (sha256, secure_url, public_id, size, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (sha256, secure_url, public_id, size, now, now)
+        )
+        evict_media_cache()
+
+def evict_media_cache():
+    """Drops expired entries, then the least recently used ones until the images add up to MEDIA_CACHE_MAX_BYTES.
+
+    Does not commit; call it inside a `with state_db:` block.
+    """
+    state_db.execute("DELETE FROM media_cache WHERE created_at < ?", (time.time() - MEDIA_CACHE_TTL_SECONDS,))
+    state_db.execute(
+        "DELETE FROM media_cache WHERE sha256 IN ("
+        "SELECT sha256 FROM (SELECT sha256, SUM(size) OVER (ORDER BY last_used_at DESC, sha256) AS total FROM media_cache) "
+        "WHERE total > ?)",
+        (MEDIA_CACHE_MAX_BYTES,)
+    )
+
+def media_cache_summary():
+    hits, misses, shared = media_cache_stats["hits"], media_cache_stats["misses"], media_cache_stats["shared"]
+    total = hits + misses
+    entries, size = state_db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media_cache").fetchone()
+    hit_rate = f"{100 * hits / total:.0f}%" if total else "n/a"
+    return (
+        f"Cloudinary cache: {hits} hits, {misses} misses ({hit_rate} hit rate), {shared} shared uploads, "
+        f"{entries} entries ({size // (1024 * 1024)} MB)"
+    )
+
+# --- Outbox Store ---
+
+def enqueue_outbox_job(job_key: str, kind: str, payload: dict, update_ids: list, media_group_id: str = None):
+    """Writes a post job to the outbox and marks its updates processed in one transaction."""
+    now = time.time()
+    with state_db:
+        cursor = state_db.execute(
+            "INSERT OR IGNORE INTO outbox_jobs (job_key, kind, payload, status, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+            (job_key, kind, json.dumps(payload), now, now, now)
+        )
+        mark_updates_processed(update_ids, media_group_id)
+    if cursor.rowcount:
+        outbox_wakeup.set()
+    else:
+        logger.info("🔁 Outbox job %s already exists. Skipping.", job_key)
+
+def attach_to_pending_job(job_key: str, messages: list, update_ids: list):
+    """Adds late album items to an album job that no worker has started yet.
+
+    Returns False, changing nothing, once the job has been claimed.
+    """
+    with state_db:
+        row = state_db.execute(
+            "SELECT id, payload FROM outbox_jobs WHERE job_key = ? AND status = 'pending' AND attempts = 0 AND platform_state = '{}'",
+            (job_key,)
+        ).fetchone()
+        if row is None:
+            return False
+        payload = json.loads(row[1])
+        known = {item["message_id"] for item in payload["messages"]}
+        payload["messages"].extend(m.to_dict() for m in messages if m.message_id not in known)
+        state_db.execute("UPDATE outbox_jobs SET payload = ?, updated_at = ? WHERE id = ?", (json.dumps(payload), time.time(), row[0]))
+        mark_updates_processed(update_ids)
+    return True
+
+def claim_outbox_job():
+    """Marks the oldest due outbox job as running and returns it, or None if nothing is due."""
+    now = time.time()
+    with state_db:
+        row = state_db.execute(
+            "SELECT id, job_key, kind, payload, attempts, platform_state FROM outbox_jobs "
+            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT 1",
+            (now,)
+        ).fetchone()
+        if row is None:
+            return None
+        state_db.execute("UPDATE outbox_jobs SET status = 'running', updated_at = ? WHERE id = ?", (now, row[0]))
+    return {
+        "id": row[0],
+        "job_key": row[1],
+        "kind": row[2],
+        "payload": json.loads(row[3]),
+        "attempts": row[4],
+        "platform_state": json.loads(row[5]),
+    }
+
+def next_outbox_job_delay():
+    """Seconds until the next pending outbox job is due (None if there is none)."""
+    row = state_db.execute("SELECT MIN(next_attempt_at) FROM outbox_jobs WHERE status = 'pending'").fetchone()
+    if row[0] is None:
+        return None
+    return max(0.0, row[0] - time.time())
+
+def record_platform_result(job: dict, platform: str, status: str):
+    """Saves the outcome of one platform post ("done", "failed", "skipped" or "unknown") for a running job.
+
+    A platform that is already done stays done, so it is never posted twice.
+    """
+    state = job["platform_state"].setdefault(platform, {"status": "pending", "attempts": 0})
+    if state["status"] == "done" and status != "done":
+        logger.warning("⚠️ %s of outbox job %s was already posted; not marking it %s.", platform, job["job_key"], status)
+        return
+    state["attempts"] += 1
+    state["status"] = status
+    with state_db:
+        state_db.execute(
+            "UPDATE outbox_jobs SET platform_state = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(job["platform_state"]), time.time(), job["id"])
+        )
+
+def save_platform_media(job: dict, platform: str, media_ids: list):
+    """Remembers media already uploaded for a platform so a retry of the job can reuse it."""
+    state = job["platform_state"].setdefault(platform, {"status": "pending", "attempts": 0})
+    state["media_ids"] = media_ids
+    state["uploaded_at"] = time.time()
+    with state_db:
+        state_db.execute(
+            "UPDATE outbox_jobs SET platform_state = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(job["platform_state"]), time.time(), job["id"])
+        )
+
+def saved_platform_media(job: dict, platform: str, max_age: float):
+    """Returns the media IDs saved by an earlier attempt if they are younger than `max_age` seconds."""
+    state = job["platform_state"].get(platform, {})
+    if state.get("media_ids") and time.time() - state["uploaded_at"] < max_age:
+        return state["media_ids"]
+    return None
+
+def defer_platform(job: dict, platform: str, delay: float):
+    """Postpones one platform of a running job until its rate limit allows it."""
+    state = job["platform_state"].setdefault(platform, {"status": "pending", "attempts": 0})
+    state["status"] = "deferred"
+    state["retry_at"] = time.time() + delay
+    state["deferrals"] = state.get("deferrals", 0) + 1
+    with state_db:
+        state_db.execute(
+            "UPDATE outbox_jobs SET platform_state = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(job["platform_state"]), time.time(), job["id"])
+        )
+
+def finish_outbox_job(job: dict, error: str = None):
+    """Closes an attempt: done, failed for good, rescheduled with backoff, or
+    postponed because only rate limits held platforms back.
+
+    Returns (status, seconds until the retry). A postponed job is pending
+    again without using up an attempt.
+    """
+    failed = any(state["status"] == "failed" for state in job["platform_state"].values())
+    deferred = [state["retry_at"] for state in job["platform_state"].values() if state["status"] == "deferred"]
+    retry_in = 0.0
+    if deferred and not (error or failed):
+        status = "postponed"
+        retry_in = max(0.0, min(deferred) - time.time())
+        logger.info("⏳ Outbox job %s postponed %.0fs for rate limits.", job["job_key"], retry_in)
+    else:
+        job["attempts"] += 1
+        if not (error or failed):
+            status = "done"
+        elif job["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            status = "failed"
+            logger.error("❌ Outbox job %s failed after %d attempts.", job["job_key"], job["attempts"])
+        else:
+            status = "pending"
+            retry_in = min(OUTBOX_RETRY_MAX_DELAY, OUTBOX_RETRY_BASE_DELAY * 2 ** (job["attempts"] - 1))
+            logger.warning("🔁 Outbox job %s will be retried in %.0fs.", job["job_key"], retry_in)
+
+    now = time.time()
+    with state_db:
+        state_db.execute(
+            "UPDATE outbox_jobs SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+            ("pending" if status == "postponed" else status, job["attempts"], now + retry_in, error, now, job["id"])
+        )
+    if status in ("pending", "postponed"):
+        outbox_wakeup.set()
+    return status, retry_in
+
+# --- Concurrency Helpers ---
+
+class PostError(Exception):
+    """Posting to a platform failed."""
+
+class GraphAPIError(PostError):
+    """A Graph API call answered without the expected ID."""
+
+async def gather_bounded(calls: list, limit: int):
+    """Runs zero-argument async callables with at most `limit` running at once.
+
+    Results are returned in the order of `calls`. If one of them raises, the
+    others are cancelled and the error is re-raised.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(call):
+        async with semaphore:
+            return await call()
+
+    tasks = [asyncio.ensure_future(run(call)) for call in calls]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def open_executors():
+    for name, size in EXECUTOR_SIZES.items():
+        if name in PROCESS_POOLS:
+            executors[name] = ProcessPoolExecutor(max_workers=size)
+            # Start the worker processes now, before the bot opens any threads
+            executors[name].submit(int).result()
+        else:
+            executors[name] = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"{name}-worker")
+
+def shutdown_executors():
+    for executor in executors.values():
+        executor.shutdown(wait=False, cancel_futures=True)
+    executors.clear()
+
+async def run_blocking(pool: str, func, *args, **kwargs):
+    """Runs a blocking call in the named executor, recording queue depth and wait time."""
+    stats = executor_stats[pool]
+    submitted_at = time.monotonic()
+    with executor_stats_lock:
+        stats["queued"] += 1
+        stats["peak_queued"] = max(stats["peak_queued"], stats["queued"])
+    started = threading.Event() # Set once a worker takes the call off the queue
+    # A publish call (see with_retries) has only been sent once a worker runs it
+    mark = publish_attempt.get()
+    if mark is not None and "sent_before" in mark:
+        mark["sent"] = mark.pop("sent_before")
+    else:
+        mark = None
+
+    def call():
+        wait_ms = int((time.monotonic() - submitted_at) * 1000)
+        if mark is not None:
+            mark["sent"] = True
+        with executor_stats_lock:
+            if not started.is_set():
+                started.set()
+                stats["queued"] -= 1
+            stats["calls"] += 1
+            stats["wait_ms"] += wait_ms
+            stats["max_wait_ms"] = max(stats["max_wait_ms"], wait_ms)
+        if wait_ms > 1000:
+            logger.warning("🐢 %s call waited %d ms for a free %s worker.", func.__name__, wait_ms, pool)
+        return func(*args, **kwargs)
+
+    future = asyncio.get_running_loop().run_in_executor(executors[pool], call)
+    try:
+        return await future
+    except asyncio.CancelledError:
+        # Cancelling the await also cancels the future even if a worker is
+        # already running the call, so only the flag tells whether it left the queue
+        with executor_stats_lock:
+            if not started.is_set():
+                started.set() # A worker that picks it up later must not count it again
+                stats["queued"] -= 1
+        raise
+
+def timed_call(submitted_at: float, func, args: tuple):
+    """Runs func(*args) in a pool process and returns (ms it waited to start, result)."""
+    return int((time.monotonic() - submitted_at) * 1000), func(*args)
+
+async def run_in_process(pool: str, func, *args):
+    """Runs CPU-bound work in a process pool. `func` and `args` must be picklable.
+
+    Counts as queued until the result is back, since the queue lives in the pool.
+    """
+    stats = executor_stats[pool]
+    with executor_stats_lock:
+        stats["queued"] += 1
+        stats["peak_queued"] = max(stats["peak_queued"], stats["queued"])
+    try:
+        wait_ms, result = await asyncio.get_running_loop().run_in_executor(
+            executors[pool], timed_call, time.monotonic(), func, args
+        )
+    finally:
+        with executor_stats_lock:
+            stats["queued"] -= 1
+    with executor_stats_lock:
+        stats["calls"] += 1
+        stats["wait_ms"] += wait_ms
+        stats["max_wait_ms"] = max(stats["max_wait_ms"], wait_ms)
+    if wait_ms > 1000:
+        logger.warning("🐢 %s call waited %d ms for a free %s worker.", func.__name__, wait_ms, pool)
+    return result
+
+def executor_summary():
+    lines = []
+    with executor_stats_lock:
+        for name, size in EXECUTOR_SIZES.items():
+            stats = executor_stats[name]
+            average_wait = stats["wait_ms"] / stats["calls"] if stats["calls"] else 0
+            kind = "processes" if name in PROCESS_POOLS else "threads"
+            lines.append(
+                f"{name} pool ({size} {kind}): {stats['queued']} queued (peak {stats['peak_queued']}), "
+                f"{stats['calls']} calls, wait avg {average_wait:.0f} ms / max {stats['max_wait_ms']} ms"
+            )
+    return "\n".join(lines)
+
+# --- Retry Policy ---
+
+class TransientError(Exception):
+    """A failure the platform reported as temporary; `retry_after` is the wait it asked for, if any."""
+
+    def __init__(self, message, retry_after: float = None, rate_limited: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.rate_limited = rate_limited
+
+def retry_after_header(headers):
+    """Seconds to wait according to a Retry-After or x-rate-limit-reset header, or None."""
+    if headers.get("retry-after", "").isdigit():
+        return float(headers["retry-after"])
+    if headers.get("x-rate-limit-reset", "").isdigit():
+        return max(0.0, int(headers["x-rate-limit-reset"]) - time.time())
+    return None
+
+def is_rate_limit_error(error: Exception):
+    if isinstance(error, TransientError):
+        return error.rate_limited
+    if isinstance(error, (tweepy.TooManyRequests, telegram.error.RetryAfter)):
+        return True
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429
+
+def failed_before_sending(error: Exception):
+    """True if the request never reached the platform because no connection could be made.
+
+    Follows wrapped errors: python-telegram-bot raises from the httpx error,
+    requests wraps urllib3's error in the ConnectionError's first argument.
+    """
+    while error is not None:
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout,
+                              requests.ConnectTimeout, NewConnectionError)):
+            return True
+        if isinstance(error, requests.ConnectionError):
+            error = getattr(error.args[0], "reason", None) if error.args else None
+        else:
+            error = error.__cause__
+    return False
+
+def classify_error(error: Exception, publish: bool = False):
+    """Returns (retryable, seconds the platform asked to wait or None) for an exception.
+
+    A `publish` call creates a post, and a timeout or 5xx may come after the
+    post was made, so only rate limits and failures before sending count as
+    retryable for it.
+    """
+    if publish and not (is_rate_limit_error(error) or failed_before_sending(error)):
+        return False, None
+    if isinstance(error, TransientError):
+        return True, error.retry_after
+    # Twitter (tweepy runs on requests)
+    if isinstance(error, tweepy.TooManyRequests):
+        return True, retry_after_header(error.response.headers)
+    if isinstance(error, tweepy.TwitterServerError):
+        return True, None
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True, None
+    # Telegram; BadRequest is a NetworkError too, but never worth repeating
+    if isinstance(error, telegram.error.RetryAfter):
+        retry_after = error.retry_after
+        return True, float(getattr(retry_after, "total_seconds", lambda: retry_after)())
+    if isinstance(error, telegram.error.BadRequest):
+        return False, None
+    if isinstance(error, (telegram.error.TimedOut, telegram.error.NetworkError)):
+        return True, None
+    # Graph API and Cloudinary (httpx)
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500, retry_after_header(error.response.headers)
+    if isinstance(error, httpx.TransportError):
+        return True, None
+    return False, None
+
+def publish_outcome_unknown(error: Exception):
+    """True if a publish call failed in a way that may come after the post was made (timeouts, 5xx)."""
+    return classify_error(error)[0] and not classify_error(error, publish=True)[0]
+
+def retry_delay(error: Exception, attempt: int, publish: bool = False):
+    """Seconds to wait before retry number `attempt`, or None if the error should not be retried."""
+    retryable, requested = classify_error(error, publish)
+    if not retryable:
+        return None
+    if requested is not None:
+        if requested > RETRY_MAX_DELAY:
+            return None
+        return requested + random.uniform(0, RETRY_BASE_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+async def with_retries(name: str, call, publish: bool = False):
+    """Runs a zero-argument async callable, retrying transient failures (see classify_error).
+
+    Pass `publish=True` for calls that create a post. While one runs, the
+    fan-out's publish_attempt mark says it may have posted.
+    """
+    mark = publish_attempt.get() if publish else None
+    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+        sent_before = mark is not None and mark["sent"]
+        try:
+            if mark is not None:
+                # run_blocking moves this to when a worker actually starts the call
+                mark["sent"], mark["sent_before"] = True, sent_before
+            return await call()
+        except Exception as e:
+            observe_rate_limit_error(e)
+            delay = retry_delay(e, attempt, publish)
+            if mark is not None and classify_error(e, publish=True)[0]:
+                mark["sent"] = sent_before # Refused or never sent: this attempt posted nothing
+            if delay is None or attempt == RETRY_MAX_ATTEMPTS:
+                raise
+            logger.warning("🔁 %s failed (%s). Retry %d/%d in %.1fs.", name, e, attempt, RETRY_MAX_ATTEMPTS - 1, delay)
+            await asyncio.sleep(delay)
+        finally:
+            if mark is not None:
+                mark.pop("sent_before", None)
+
+def is_transient_graph_error(error: dict):
+    return bool(error.get("is_transient")) or error.get("code") in GRAPH_TRANSIENT_ERROR_CODES
+
+async def graph_post(path: str, data: dict, publish: bool = False):
+    """POSTs to the Graph API and returns the decoded body, retrying transient errors.
+
+    Permanent errors come back as the usual {"error": ...} body; transient ones
+    that outlast the retries raise TransientError. Pass `publish=True` when
+    the call creates a post (see with_retries).
+    """
+    async def call():
+        response = await graph_client.post(path, data=data)
+        observe_graph_usage(response.headers)
+        if response.status_code >= 500:
+            raise TransientError(f"Graph API answered {response.status_code}")
+        body = response.json()
+        error = body.get("error") if isinstance(body, dict) else None
+        if error and is_transient_graph_error(error):
+            raise TransientError(
+                f"Graph API error {error.get('code')}: {error.get('message')}",
+                rate_limited=error.get("code") in GRAPH_RATE_LIMIT_ERROR_CODES
+            )
+        return body
+    return await with_retries(f"Graph API POST {path}", call, publish)
+
+# --- Rate Governor ---
+
+class RateGovernor:
+    """A token bucket pacing one platform account, persisted in the state DB.
+
+    `capacity` posts are allowed per `window` seconds and tokens refill
+    continuously. Usage reported by the platform can drain the bucket or
+    block it until a given time.
+    """
+
+    def __init__(self, platform: str, account: str, capacity: int, window: float):
+        self.platform = platform
+        self.account = account
+        self.capacity = capacity
+        self.window = window
+        self.tokens = float(capacity)
+        self.updated_at = time.time()
+        self.blocked_until = 0.0
+        self.usage_percent = None # Highest usage share the platform last reported
+        row = state_db.execute("SELECT value FROM bot_state WHERE key = ?", (self._state_key(),)).fetchone()
+        if row:
+            saved = json.loads(row[0])
+            self.tokens, self.updated_at, self.blocked_until = saved["tokens"], saved["updated_at"], saved["blocked_until"]
+
+    def _state_key(self):
+        return f"rate:{self.platform}:{self.account}"
+
+    def _save(self):
+        value = json.dumps({"tokens": self.tokens, "updated_at": self.updated_at, "blocked_until": self.blocked_until})
+        with state_db:
+            state_db.execute(
+                "INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (self._state_key(), value)
+            )
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.capacity / self.window)
+        self.updated_at = now
+
+    def remaining(self):
+        """Posts that can go out right now."""
+        self._refill()
+        if self.blocked_until > time.time():
+            return 0
+        return max(0, int(self.tokens))
+
+    def reserve(self):
+        """Takes a token and returns how many seconds to wait before posting with it."""
+        self._refill()
+        self.tokens -= 1
+        wait = max(0.0, self.blocked_until - time.time())
+        if self.tokens < 0:
+            wait = max(wait, -self.tokens * self.window / self.capacity)
+        self._save()
+        return wait
+
+    def cancel(self):
+        """Gives back a reserved token that was not used."""
+        self.tokens += 1
+        self._save()
+
+    def block(self, seconds: float):
+        """Holds every post back for `seconds`, e.g. until a reported reset."""
+        self.blocked_until = max(self.blocked_until, time.time() + seconds)
+        logger.warning("🚦 %s rate limit reached; holding posts for %.0fs.", self.platform, seconds)
+        self._save()
+
+    def observe_usage(self, percent: float, regain_seconds: float = 0):
+        """Tightens the bucket from a usage share (0-100) reported by the platform."""
+        self.usage_percent = percent
+        if regain_seconds:
+            self.block(regain_seconds)
+        elif percent >= 100:
+            self.block(60)
+        elif percent >= GRAPH_USAGE_THROTTLE_PERCENT:
+            # Close to the limit: no bursts, only the steady refill rate
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+            self._save()
+
+    def summary(self):
+        window = f"{self.window / 3600:g}h" if self.window >= 3600 else f"{self.window / 60:g} min"
+        text = f"{self.platform}: {self.remaining()}/{self.capacity} posts left per {window}"
+        if self.blocked_until > time.time():
+            text += f", blocked for {self.blocked_until - time.time():.0f}s"
+        if self.usage_percent is not None:
+            text += f", API usage {self.usage_percent:.0f}%"
+        return text
+
+def platform_account(platform: str):
+    """The account a platform posts as, so each account gets its own bucket."""
+    return {
+        "twitter": (TWITTER_ACCESS_TOKEN_V1 or "").split("-")[0], # OAuth 1.0a tokens start with the user ID
+        "facebook": FB_PAGE_ID,
+        "instagram": IG_ACCOUNT_ID,
+        "telegram": TELEGRAM_CHANNEL_ID,
+    }.get(platform) or "default"
+
+def rate_governor(platform: str):
+    """Returns the RateGovernor for a platform's account, or None if it is not rate limited."""
+    if platform not in RATE_LIMITS:
+        return None
+    key = (platform, platform_account(platform))
+    governor = rate_governors.get(key)
+    if governor is None:
+        governor = rate_governors[key] = RateGovernor(platform, key[1], *RATE_LIMITS[platform])
+    return governor
+
+def observe_graph_usage(headers):
+    """Feeds the X-App-Usage and X-Business-Use-Case-Usage headers into the Graph governors."""
+    try:
+        app_usage = json.loads(headers.get("x-app-usage") or "{}")
+        if app_usage:
+            # App usage counts every Graph call, Facebook and Instagram alike
+            percent = max(app_usage.values())
+            for platform in ("facebook", "instagram"):
+                rate_governor(platform).observe_usage(percent)
+        business_usage = json.loads(headers.get("x-business-use-case-usage") or "{}")
+        for object_id, entries in business_usage.items():
+            platform = "instagram" if object_id in (IG_ACCOUNT_ID, IG_PAGE_ID) else "facebook"
+            for entry in entries:
+                percent = max(entry.get("call_count", 0), entry.get("total_cputime", 0), entry.get("total_time", 0))
+                regain_seconds = entry.get("estimated_time_to_regain_access", 0) * 60
+                rate_governor(platform).observe_usage(percent, regain_seconds)
+    except (ValueError, TypeError, AttributeError):
+        logger.warning("⚠️ Could not parse Graph API usage headers.")
+
+def observe_rate_limit_error(error: Exception):
+    """Blocks a platform's governor when an error says its rate limit was hit."""
+    if isinstance(error, tweepy.TooManyRequests):
+        rate_governor("twitter").block(retry_after_header(error.response.headers) or 15 * 60)
+    elif isinstance(error, telegram.error.RetryAfter):
+        rate_governor("telegram").block(classify_error(error)[1])
+
+def rate_governor_summary():
+    return "\n".join(rate_governor(platform).summary() for platform in RATE_LIMITS)
+
+# --- Graph API Batch Requests ---
+
+def encode_batch_body(params: dict):
+    """URL-encodes the body of a batch operation, leaving {result=...} references readable for Graph."""
+    def encode(value):
+        value = str(value)
+        parts, last = [], 0
+        for match in GRAPH_BATCH_REFERENCE.finditer(value):
+            parts.append(quote_plus(value[last:match.start()], safe=""))
+            parts.append(match.group(0))
+            last = match.end()
+        parts.append(quote_plus(value[last:], safe=""))
+        return "".join(parts)
+    return "&".join(f"{quote_plus(key)}={encode(value)}" for key, value in params.items())
+
+def graph_batch_operation(method: str, relative_url: str, params: dict = None, name: str = None):
+    """Builds one operation for graph_batch().
+
+    Named operations can be referenced by later ones in the same batch as
+    {result=<name>:$.id}; their own responses are kept in the results.
+    """
+    operation = {"method": method, "relative_url": relative_url.lstrip("/")}
+    if params:
+        operation["body"] = encode_batch_body(params)
+    if name:
+        operation["name"] = name
+        operation["omit_response_on_success"] = False
+    return operation
+
+async def graph_batch(operations: list, access_token: str, publish: bool = False):
+    """Sends Graph API operations as batch requests of up to 50 and unpacks the results.
+
+    Returns one decoded JSON body per operation, in order. Failed operations
+    come back as {"error": ...}. References between operations only work
+    within the same chunk of GRAPH_BATCH_LIMIT. Pass `publish=True` if an
+    operation creates a post.
+    """
+    results = []
+    for start in range(0, len(operations), GRAPH_BATCH_LIMIT):
+        chunk = operations[start:start + GRAPH_BATCH_LIMIT]
+        # Only a failure of the whole batch is retried, never single operations
+        data = await graph_post("/", {"batch": json.dumps(chunk), "include_headers": "false", "access_token": access_token}, publish)
+        if not isinstance(data, list):
+            raise GraphAPIError(f"Graph batch request failed: {data}")
+        for item in data:
+            if item is None:
+                # Graph gives no response for operations it skipped because a dependency failed
+                results.append({"error": {"message": "Operation skipped by the Graph API"}})
+                continue
+            try:
+                body = json.loads(item.get("body") or "null")
+            except ValueError:
+                body = {"error": {"message": item.get("body")}}
+            if item.get("code") != 200 and not (isinstance(body, dict) and "error" in body):
+                body = {"error": {"code": item.get("code"), "message": body}}
+            results.append(body)
+    return results
+
+def first_batch_error(results: list):
+    return next((r["error"] for r in results if isinstance(r, dict) and "error" in r), None)
+
+# --- Media Handling ---
+
+def sha256_sync(source):
+    """Hex SHA-256 of bytes or of the file at a path. Runs in a thread: hashlib releases the GIL."""
+    digest = hashlib.sha256()
+    if isinstance(source, str):
+        with open(source, "rb") as reader:
+            for chunk in iter(lambda: reader.read(1024 * 1024), b""):
+                digest.update(chunk)
+    else:
+        digest.update(source)
+    return digest.hexdigest()
+
+class TelegramMedia:
+    """A photo downloaded once from Telegram and shared by every platform.
+
+    Small files live in memory and open() hands out independent readers over
+    the same bytes, so concurrent uploads never copy or re-read them. Large
+    files are spooled to a uniquely named temp file that close() removes.
+    """
+
+    def __init__(self, file_id: str, width: int = None, height: int = None):
+        self.file_id = file_id
+        self.width = width
+        self.height = height
+        self.filename = f"{file_id}.jpg" # Only used to tell uploaders the file type
+        self._data = None
+        self._spool_path = None
+        self._sha256 = None
+        self._hashing = None # The hash in progress, shared by concurrent callers
+
+    @classmethod
+    async def download(cls, photo: telegram.PhotoSize, bot_instance: telegram.Bot):
+        media = cls(photo.file_id, photo.width, photo.height)
+        file_obj = await bot_instance.get_file(photo.file_id)
+        size = file_obj.file_size or photo.file_size or 0
+        if size > MEDIA_SPOOL_THRESHOLD:
+            fd, media._spool_path = tempfile.mkstemp(prefix="media_", suffix=".jpg")
+            os.close(fd)
+            await file_obj.download_to_drive(media._spool_path)
+        else:
+            media._data = bytes(await file_obj.download_as_bytearray())
+        return media
+
+    @classmethod
+    def from_bytes(cls, file_id: str, data: bytes, width: int, height: int, sha256: str = None):
+        """Wraps an image produced by the bot itself, e.g. a platform rendition."""
+        media = cls(file_id, width, height)
+        media._data = data
+        media._sha256 = sha256
+        return media
+
+    def open(self):
+        """Returns a new binary reader positioned at the start of the photo."""
+        if self._spool_path:
+            return open(self._spool_path, "rb")
+        return io.BytesIO(self._data) # Shares the bytes object, nothing is copied
+
+    def read(self):
+        if self._spool_path:
+            with open(self._spool_path, "rb") as spool_file:
+                return spool_file.read()
+        return self._data
+
+    @property
+    def size(self):
+        if self._spool_path:
+            return os.path.getsize(self._spool_path)
+        return len(self._data)
+
+    async def sha256(self):
+        """Hex SHA-256 of the photo bytes, used as its content address.
+
+        Hashed once, in a thread so the event loop never waits on it and the
+        bytes are not copied to another process. Concurrent callers share it.
+        """
+        if self._sha256 is None:
+            if self._hashing is None:
+                self._hashing = asyncio.ensure_future(asyncio.to_thread(sha256_sync, self._spool_path or self._data))
+            # Shielded so a caller that gives up does not cancel the others' hash
+            self._sha256 = await asyncio.shield(self._hashing)
+        return self._sha256
+
+    def close(self):
+        if self._spool_path and os.path.exists(self._spool_path):
+            os.remove(self._spool_path)
+        self._spool_path = None
+        self._data = None
+
+# --- HTTP Client Lifecycle ---
+
+def create_telegram_bot():
+    """Creates the Telegram bot with a connection pool sized for the outbox workers."""
+    http_version = "2" if HTTP2_AVAILABLE else "1.1"
+    return telegram.Bot(
+        token=TELEGRAM_BOT_TOKEN,
+        request=HTTPXRequest(connection_pool_size=MAX_CONCURRENT_UPDATES * 2 + 4, http_version=http_version),
+        get_updates_request=HTTPXRequest(http_version=http_version)
+    )
+
+async def open_http_clients(bot_instance: telegram.Bot):
+    """Opens the shared HTTP clients and warms up their connections."""
+    global graph_client, cloudinary_client, twitter_upload_client
+    graph_client = httpx.AsyncClient(
+        base_url=GRAPH_API_URL, http2=HTTP2_AVAILABLE, limits=HTTP_POOL_LIMITS, timeout=HTTP_TIMEOUT
+    )
+    cloudinary_client = httpx.AsyncClient(
+        base_url=f"{CLOUDINARY_API_URL}/{CLOUDINARY_CLOUD_NAME}", http2=HTTP2_AVAILABLE, limits=HTTP_POOL_LIMITS, timeout=HTTP_TIMEOUT
+    )
+    twitter_upload_client = httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=HTTP_POOL_LIMITS, timeout=HTTP_TIMEOUT)
+    warm_ups = [bot_instance.initialize(), warm_up_twitter_clients()]
+    # Any response will do for these, they only open the connection
+    if (FB_PAGE_ID and FB_PAGE_ACCESS_TOKEN) or (IG_ACCOUNT_ID and IG_ACCESS_TOKEN):
+        warm_ups.append(graph_client.get("/"))
+    if CLOUDINARY_CLOUD_NAME and CLOUDINARY_ASYNC_UPLOADS:
+        warm_ups.append(cloudinary_client.get("/"))
+    if twitter_configured() and TWITTER_ASYNC_UPLOADS:
+        warm_ups.append(twitter_upload_client.head(TWITTER_UPLOAD_URL))
+    for result in await asyncio.gather(*warm_ups, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.warning("⚠️ Connection warm-up failed: %s", result)
+    logger.info("🔌 HTTP clients ready (HTTP/2: %s).", "on" if HTTP2_AVAILABLE else "off")
+
+async def close_http_clients(bot_instance: telegram.Bot):
+    for client in (graph_client, cloudinary_client, twitter_upload_client):
+        if client:
+            await client.aclose()
+    await bot_instance.shutdown()
+
+# --- Twitter Posting Functions ---
+
+def get_twitter_clients(consumer_key=None, consumer_secret=None, access_token=None, access_token_secret=None):
+    """Returns the shared (v2 Client, v1.1 API) pair for a credential set, building it on first use.
+
+    Defaults to the bot's own TWITTER_*_V1 credentials. Both objects keep their
+    own requests session, so reusing them also reuses the open connections.
+    """
+    key = (
+        consumer_key or TWITTER_API_KEY_V1,
+        consumer_secret or TWITTER_API_SECRET_V1,
+        access_token or TWITTER_ACCESS_TOKEN_V1,
+        access_token_secret or TWITTER_ACCESS_TOKEN_SECRET_V1,
+    )
+    clients = twitter_clients.get(key)
+    if clients is None:
+        client_v2 = tweepy.Client(
+            consumer_key=key[0],
+            consumer_secret=key[1],
+            access_token=key[2],
+            access_token_secret=key[3]
+        )
+        api_v1 = tweepy.API(tweepy.OAuth1UserHandler(*key))
+        clients = twitter_clients[key] = (client_v2, api_v1)
+    return clients
+
+def twitter_configured():
+    return all([TWITTER_API_KEY_V1, TWITTER_API_SECRET_V1, TWITTER_ACCESS_TOKEN_V1, TWITTER_ACCESS_TOKEN_SECRET_V1])
+
+async def warm_up_twitter_clients():
+    """Builds the Twitter clients at startup and checks that the credentials work."""
+    if not twitter_configured():
+        return
+    client_v2, _ = get_twitter_clients()
+    try:
+        response = await run_blocking("twitter", client_v2.get_me, user_auth=True)
+        logger.info("🐦 Twitter credentials verified for @%s.", response.data.username)
+    except Exception as e:
+        logger.warning("⚠️ Could not verify Twitter credentials at startup: %s", e)
+
+def upload_twitter_image(api_v1: tweepy.API, image: TelegramMedia):
+    with image.open() as reader:
+        return api_v1.media_upload(filename=image.filename, file=reader)
+
+def oauth_quote(value):
+    return quote(str(value), safe="~")
+
+def twitter_oauth1_header(method: str, url: str, params: dict):
+    """OAuth 1.0a Authorization header signed with the bot's own Twitter keys.
+
+    Only the URL and its query parameters are signed, as Twitter expects for
+    multipart uploads, so every upload parameter travels in the query string.
+    """
+    oauth = {
+        "oauth_consumer_key": TWITTER_API_KEY_V1,
+        "oauth_nonce": secrets.token_hex(16),
+        "oauth_signature_method": "HMAC-SHA1",
+        "oauth_timestamp": str(int(time.time())),
+        "oauth_token": TWITTER_ACCESS_TOKEN_V1,
+        "oauth_version": "1.0",
+    }
+    pairs = sorted((oauth_quote(key), oauth_quote(value)) for key, value in {**params, **oauth}.items())
+    base = "&".join([method.upper(), oauth_quote(url), oauth_quote("&".join(f"{key}={value}" for key, value in pairs))])
+    signing_key = f"{oauth_quote(TWITTER_API_SECRET_V1)}&{oauth_quote(TWITTER_ACCESS_TOKEN_SECRET_V1)}"
+    signature = hmac.new(signing_key.encode(), base.encode(), hashlib.sha1).digest()
+    oauth["oauth_signature"] = base64.b64encode(signature).decode()
+    return "OAuth " + ", ".join(f'{oauth_quote(key)}="{oauth_quote(value)}"' for key, value in sorted(oauth.items()))
+
+async def twitter_upload_command(method: str, params: dict, segment=None):
+    """Sends one INIT/APPEND/FINALIZE/STATUS command and returns the decoded body."""
+    headers = {"Authorization": twitter_oauth1_header(method, TWITTER_UPLOAD_URL, params)}
+    files = {"media": ("blob", segment, "application/octet-stream")} if segment is not None else None
+    response = await twitter_upload_client.request(method, TWITTER_UPLOAD_URL, params=params, headers=headers, files=files)
+    response.raise_for_status()
+    return response.json() if response.content else {}
+
+def twitter_media_category(media_type: str):
+    if media_type == "image/gif":
+        return "tweet_gif"
+    if media_type.startswith("video/"):
+        return "tweet_video"
+    return "tweet_image"
+
+class TwitterChunkedUpload:
+    """One chunked media upload (INIT, APPEND segments, FINALIZE, STATUS).
+
+    Segments are read one at a time from the image's buffer, so nothing is
+    copied up front. The upload remembers its media ID and how many segments
+    Twitter acknowledged, so running it again after a transient failure
+    resumes with the next segment instead of starting over.
+    """
+
+    def __init__(self, image: TelegramMedia):
+        self.image = image
+        self.media_type = mimetypes.guess_type(image.filename)[0] or "image/jpeg"
+        self.media_id = None
+        self.segments_sent = 0
+        self.processing_info = None
+        self.finalized = False
+
+    async def run(self):
+        """Uploads (or resumes uploading) the image and returns its media ID."""
+        if self.media_id is None:
+            data = await twitter_upload_command("POST", {
+                "command": "INIT",
+                "total_bytes": self.image.size,
+                "media_type": self.media_type,
+                "media_category": twitter_media_category(self.media_type),
+            })
+            self.media_id = data["media_id_string"]
+
+        if not self.finalized:
+            with self.image.open() as reader:
+                reader.seek(self.segments_sent * TWITTER_UPLOAD_CHUNK_SIZE)
+                for segment in iter(lambda: reader.read(TWITTER_UPLOAD_CHUNK_SIZE), b""):
+                    await twitter_upload_command(
+                        "POST", {"command": "APPEND", "media_id": self.media_id, "segment_index": self.segments_sent}, segment
+                    )
+                    self.segments_sent += 1
+            data = await twitter_upload_command("POST", {"command": "FINALIZE", "media_id": self.media_id})
+            self.processing_info = data.get("processing_info")
+            self.finalized = True
+
+        # GIFs and videos are processed asynchronously after FINALIZE
+        while self.processing_info and self.processing_info.get("state") in ("pending", "in_progress"):
+            await asyncio.sleep(self.processing_info.get("check_after_secs", 1))
+            data = await twitter_upload_command("GET", {"command": "STATUS", "media_id": self.media_id})
+            self.processing_info = data.get("processing_info")
+        if self.processing_info and self.processing_info.get("state") == "failed":
+            raise PostError(f"Twitter could not process media {self.media_id}: {self.processing_info.get('error')}")
+        return self.media_id
+
+async def upload_twitter_image_with_retries(api_v1: tweepy.API, image: TelegramMedia):
+    """Uploads one image to Twitter and returns its media ID.
+
+    Uses the async chunked upload, falling back to tweepy's media_upload if that fails.
+    """
+    if TWITTER_ASYNC_UPLOADS and twitter_upload_client:
+        upload = TwitterChunkedUpload(image)
+        try:
+            return await with_retries("Twitter chunked upload", upload.run)
+        except Exception as e:
+            logger.warning("⚠️ Chunked Twitter upload failed (%s). Retrying with tweepy.", e)
+    media = await with_retries(
+        "Twitter media upload", lambda: run_blocking("twitter", upload_twitter_image, api_v1, image)
+    )
+    return media.media_id_string
+
+async def upload_twitter_media(api_v1: tweepy.API, images: list):
+    """Uploads images to Twitter at the same time and returns their media IDs in order.
+
+    Each upload retries transient errors on its own; if one still fails the
+    error is raised so the tweet is not sent with missing images.
+    """
+    return list(await asyncio.gather(*(upload_twitter_image_with_retries(api_v1, image) for image in images)))
+
+async def post_to_twitter(caption: str, images: list = None, media_ids: list = None):
+    """Posts a text tweet or an image tweet (up to 4) to Twitter.
+
+    Images are uploaded first, unless their `media_ids` were uploaded already.
+    Like every post_to_* function it returns the ID of the new post, returns
+    None when the platform is skipped (not configured or not applicable) and
+    raises when posting fails.
+    """
+    if not twitter_configured():
+        logger.error("❌ Twitter API v1.1 credentials are not set. Skipping Twitter post.")
+        return None
+
+    client_v2, api_v1 = get_twitter_clients()
+
+    if media_ids:
+        logger.info("🐦 Using %d already uploaded Twitter image(s).", len(media_ids))
+    elif images and len(images) <= 4:
+        logger.info("🐦 Uploading %d image(s) to Twitter...", len(images))
+        media_ids = await upload_twitter_media(api_v1, images)
+        logger.info("✅ Twitter media uploaded. Media IDs: %s", media_ids)
+    elif images and len(images) > 4:
+        logger.warning("Twitter only supports up to 4 images. Skipping Twitter post.")
+        return None
+
+    # Only the tweet itself is retried; the uploaded media IDs are reused
+    response = await with_retries(
+        "Twitter create_tweet",
+        lambda: run_blocking("twitter", client_v2.create_tweet, text=caption, media_ids=media_ids or []),
+        publish=True
+    )
+    tweet_id = response.data["id"]
+    logger.info("✅ Successfully posted to Twitter! Tweet ID: %s", tweet_id)
+    return tweet_id
+
+# --- Facebook Posting Functions ---
+
+async def post_to_facebook_page(message: str, image_url: str = None):
+    """Posts text or a single image to a Facebook Page."""
+    if not all([FB_PAGE_ID, FB_PAGE_ACCESS_TOKEN]):
+        logger.error("❌ Facebook Page ID or Access Token not set.")
+        return None
+
+    if image_url:
+        url = f"/{FB_PAGE_ID}/photos"
+        data = await graph_post(url, {"url": image_url, "caption": message, "access_token": FB_PAGE_ACCESS_TOKEN}, publish=True)
+    else:
+        url = f"/{FB_PAGE_ID}/feed"
+        data = await graph_post(url, {"message": message, "access_token": FB_PAGE_ACCESS_TOKEN}, publish=True)
+
+    if "id" not in data:
+        raise GraphAPIError(f"Failed to post to Facebook Page: {data}")
+    post_id = data.get("post_id", data["id"]) # Photo uploads answer with the photo ID and the post ID
+    logger.info("✅ Successfully posted to Facebook Page! Post ID: %s", post_id)
+    return post_id
+
+async def upload_unpublished_facebook_photo(image_url: str):
+    """Uploads a photo to the Page without publishing it and returns its ID."""
+    upload_url = f"/{FB_PAGE_ID}/photos"
+    data = await graph_post(upload_url, {"url": image_url, "published": "false", "access_token": FB_PAGE_ACCESS_TOKEN})
+    if "id" not in data:
+        raise GraphAPIError(f"Failed to upload a photo for the Facebook album: {data}")
+    return data["id"]
+
+async def post_facebook_album_batch(caption: str, image_urls: list):
+    """Uploads the photos and creates the album feed post in a single batch request.
+
+    Returns the feed post's response, or {"error": ...} for the first failed step.
+    """
+    operations = [
+        graph_batch_operation("POST", f"{FB_PAGE_ID}/photos", {"url": url, "published": "false"}, name=f"photo{i}")
+        for i, url in enumerate(image_urls)
+    ]
+    attached_media = [{"media_fbid": f"{{result=photo{i}:$.id}}"} for i in range(len(image_urls))]
+    operations.append(graph_batch_operation("POST", f"{FB_PAGE_ID}/feed", {"message": caption, "attached_media": json.dumps(attached_media)}))
+    results = await graph_batch(operations, FB_PAGE_ACCESS_TOKEN, publish=True)
+    error = first_batch_error(results)
+    return {"error": error} if error else results[-1]
+
+async def post_album_to_facebook_page(caption: str, image_urls: list):
+    """Uploads multiple images as a single album post to a Facebook Page."""
+    if not all([FB_PAGE_ID, FB_PAGE_ACCESS_TOKEN]):
+        logger.error("❌ Facebook Page ID or Access Token not set.")
+        return None
+    if not image_urls:
+        return None
+
+    if GRAPH_BATCH_REQUESTS:
+        logger.info("Posting %d photos to Facebook as one batch request...", len(image_urls))
+        data = await post_facebook_album_batch(caption, image_urls)
+    else:
+        logger.info("Uploading %d photos to Facebook for album post...", len(image_urls))
+        # Step 1: Upload every photo with 'published=false' at the same time to get their IDs
+        media_ids = await gather_bounded(
+            [functools.partial(upload_unpublished_facebook_photo, url) for url in image_urls],
+            GRAPH_MAX_CONCURRENT_REQUESTS
+        )
+
+        logger.info("✅ All photos uploaded to Facebook. Creating feed post...")
+        # Step 2: Create the feed post with all the uploaded photo IDs, in the original order
+        feed_url = f"/{FB_PAGE_ID}/feed"
+        attached_media = [{"media_fbid": media_id} for media_id in media_ids]
+        data = await graph_post(feed_url, {"message": caption, "attached_media": json.dumps(attached_media), "access_token": FB_PAGE_ACCESS_TOKEN}, publish=True)
+
+    if "id" not in data:
+        raise GraphAPIError(f"Failed to post album to Facebook Page: {data}")
+    logger.info("✅ Successfully posted album to Facebook Page! Post ID: %s", data["id"])
+    return data["id"]
+
+# --- Instagram Posting Functions ---
+
+async def create_instagram_carousel_item(image_url: str):
+    """Creates one carousel child container and returns its ID."""
+    container_url = f"/{IG_ACCOUNT_ID}/media"
+    container_data = await graph_post(container_url, {"image_url": image_url, "is_carousel_item": "true", "access_token": IG_ACCESS_TOKEN})
+    if 'id' not in container_data:
+        raise GraphAPIError(f"Failed to create Instagram media container for {image_url}. Error: {container_data.get('error', 'Unknown')}")
+    return container_data['id']
+
+async def post_instagram_carousel_batch(image_urls: list, caption: str):
+    """Creates the child containers, the carousel container and publishes it in one batch request.
+
+    Returns the publish response, or {"error": ...} for the first failed step.
+    """
+    operations = [
+        graph_batch_operation("POST", f"{IG_ACCOUNT_ID}/media", {"image_url": url, "is_carousel_item": "true"}, name=f"child{i}")
+        for i, url in enumerate(image_urls)
+    ]
+    children = ",".join(f"{{result=child{i}:$.id}}" for i in range(len(image_urls)))
+    operations.append(graph_batch_operation("POST", f"{IG_ACCOUNT_ID}/media", {"caption": caption, "media_type": "CAROUSEL", "children": children}, name="carousel"))
+    operations.append(graph_batch_operation("POST", f"{IG_ACCOUNT_ID}/media_publish", {"creation_id": "{result=carousel:$.id}"}))
+    results = await graph_batch(operations, IG_ACCESS_TOKEN, publish=True)
+    error = first_batch_error(results)
+    return {"error": error} if error else results[-1]
+
+async def post_to_instagram_feed(image_urls: list, caption: str):
+    """Posts a single image or a carousel to Instagram Feed."""
+    if not all([IG_ACCOUNT_ID, IG_ACCESS_TOKEN]):
+        logger.error("❌ Instagram credentials not set.")
+        return None
+
+    if len(image_urls) == 1:
+        # Post a single image
+        container_url = f"/{IG_ACCOUNT_ID}/media"
+        container_data = await graph_post(container_url, {"image_url": image_urls[0], "caption": caption, "access_token": IG_ACCESS_TOKEN})
+        if 'id' not in container_data:
+            raise GraphAPIError(f"Failed to create Instagram container for single image: {container_data.get('error', 'Unknown')}")
+        publish_url = f"/{IG_ACCOUNT_ID}/media_publish"
+        publish_data = await graph_post(publish_url, {"creation_id": container_data['id'], "access_token": IG_ACCESS_TOKEN}, publish=True)
+        if 'id' not in publish_data:
+            raise GraphAPIError(f"Instagram single image publish failed: {publish_data}")
+        logger.info("✅ Successfully posted single image to Instagram! Post ID: %s", publish_data['id'])
+        return publish_data['id']
+
+    # Post a carousel for multiple images
+    if GRAPH_BATCH_REQUESTS:
+        logger.info("Posting %d images to Instagram as one batch request...", len(image_urls))
+        publish_data = await post_instagram_carousel_batch(image_urls, caption)
+        if 'id' not in publish_data:
+            raise GraphAPIError(f"Instagram carousel batch failed: {publish_data.get('error', 'Unknown')}")
+        logger.info("✅ Successfully posted carousel to Instagram! Post ID: %s", publish_data['id'])
+        return publish_data['id']
+
+    logger.info("Uploading %d images for Instagram carousel...", len(image_urls))
+    child_ids = await gather_bounded(
+        [functools.partial(create_instagram_carousel_item, url) for url in image_urls],
+        GRAPH_MAX_CONCURRENT_REQUESTS
+    )
+
+    carousel_url = f"/{IG_ACCOUNT_ID}/media"
+    carousel_data = await graph_post(carousel_url, {"caption": caption, "media_type": "CAROUSEL", "children": ",".join(child_ids), "access_token": IG_ACCESS_TOKEN})
+    if 'id' not in carousel_data:
+        raise GraphAPIError(f"Failed to create Instagram carousel container: {carousel_data.get('error', 'Unknown')}")
+    publish_url = f"/{IG_ACCOUNT_ID}/media_publish"
+    publish_data = await graph_post(publish_url, {"creation_id": carousel_data['id'], "access_token": IG_ACCESS_TOKEN}, publish=True)
+    if 'id' not in publish_data:
+        raise GraphAPIError(f"Instagram carousel publish failed: {publish_data}")
+    logger.info("✅ Successfully posted carousel to Instagram! Post ID: %s", publish_data['id'])
+    return publish_data['id']
+
+# --- Helper & Telegram Functions (No Changes Below This Line) ---
+
+async def send_photos_to_channel(photos: list, caption: str, bot_instance: telegram.Bot):
+    """Sends photos (file_ids or bytes) to the channel as one photo or one album.
+
+    Returns the ID of the (first) channel message.
+    """
+    if len(photos) > 1:
+        # Correctly create the media list, adding the caption only to the first item
+        media = [
+            telegram.InputMediaPhoto(media=photo, caption=caption if i == 0 else None)
+            for i, photo in enumerate(photos)
+        ]
+        messages = await bot_instance.send_media_group(chat_id=TELEGRAM_CHANNEL_ID, media=media)
+        return messages[0].message_id
+    message = await bot_instance.send_photo(chat_id=TELEGRAM_CHANNEL_ID, photo=photos[0], caption=caption)
+    return message.message_id
+
+async def post_to_telegram_channel(file_ids: list, caption: str, bot_instance: telegram.Bot, get_images=None):
+    """Posts one or more photos to the configured Telegram channel.
+
+    Telegram already has the photos, so they are re-sent by file_id without
+    uploading any bytes. If Telegram rejects a file_id, the downloaded photos
+    returned by the async callable `get_images` are uploaded instead.
+    """
+    if not TELEGRAM_CHANNEL_ID:
+        logger.error("❌ TELEGRAM_CHANNEL_ID is not set.")
+        return None
+    if not file_ids:
+        return None
+    try:
+        return await with_retries("Telegram repost", lambda: send_photos_to_channel(file_ids, caption, bot_instance), publish=True)
+    except telegram.error.BadRequest as e:
+        if get_images is None:
+            raise
+        logger.warning("⚠️ Telegram rejected the file_id repost (%s). Uploading the files instead.", e)
+    photos = [image.read() for image in await get_images()]
+    return await with_retries("Telegram upload", lambda: send_photos_to_channel(photos, caption, bot_instance), publish=True)
+
+async def post_text_to_telegram_channel(text: str, bot_instance: telegram.Bot):
+    if not TELEGRAM_CHANNEL_ID:
+        logger.error("❌ TELEGRAM_CHANNEL_ID is not set.")
+        return None
+    message = await with_retries(
+        "Telegram send_message", lambda: bot_instance.send_message(chat_id=TELEGRAM_CHANNEL_ID, text=text), publish=True
+    )
+    return message.message_id
+
+def upload_to_cloudinary_sync(image: TelegramMedia):
+    with image.open() as reader:
+        return cloudinary.uploader.upload(reader)
+
+def cloudinary_signature(params: dict):
+    """Signs upload parameters the same way the Cloudinary SDK does (SHA-1 of the sorted params + secret)."""
+    to_sign = "&".join(f"{key}={value}" for key, value in sorted(params.items()) if value not in (None, ""))
+    return hashlib.sha1((to_sign + CLOUDINARY_API_SECRET).encode("utf-8")).hexdigest()
+
+async def upload_to_cloudinary_async(image: TelegramMedia):
+    """Signed upload over the shared httpx client, streaming the image without a thread."""
+    params = {"timestamp": str(int(time.time()))}
+    data = dict(params, api_key=CLOUDINARY_API_KEY, signature=cloudinary_signature(params))
+    with image.open() as reader:
+        response = await cloudinary_client.post("/image/upload", data=data, files={"file": (image.filename, reader, "image/jpeg")})
+    response.raise_for_status()
+    return response.json()
+
+async def upload_to_cloudinary(image: TelegramMedia):
+    """Uploads with the async client, falling back to the SDK if that fails."""
+    if CLOUDINARY_ASYNC_UPLOADS and cloudinary_client:
+        try:
+            return await with_retries("Cloudinary upload", lambda: upload_to_cloudinary_async(image))
+        except Exception as e:
+            logger.warning("⚠️ Async Cloudinary upload failed (%s). Retrying with the SDK.", e)
+    return await run_blocking("cloudinary", upload_to_cloudinary_sync, image)
+
+async def upload_image_to_cloudinary(image: TelegramMedia):
+    """Returns a Cloudinary URL for the image, uploading it only if its content is not cached."""
+    if not CLOUDINARY_CLOUD_NAME:
+        return None
+    digest = await image.sha256()
+    cached_url = lookup_media_cache(digest)
+    if cached_url:
+        media_cache_stats["hits"] += 1
+        logger.info("♻️ Reusing Cloudinary upload for image %s…", digest[:12])
+        return cached_url
+
+    # Another post may be uploading the very same image right now
+    upload = cloudinary_uploads_in_flight.get(digest)
+    if upload is None:
+        media_cache_stats["misses"] += 1
+        upload = asyncio.ensure_future(upload_to_cloudinary(image))
+        cloudinary_uploads_in_flight[digest] = upload
+        upload.add_done_callback(lambda _: cloudinary_uploads_in_flight.pop(digest, None))
+    else:
+        media_cache_stats["shared"] += 1
+    try:
+        result = await asyncio.shield(upload)
+    except Exception:
+        logger.exception("❌ Failed to upload image to Cloudinary.")
+        return None
+    secure_url = result.get('secure_url')
+    if secure_url and lookup_media_cache(digest) is None:
+        store_media_cache(digest, secure_url, result.get('public_id'), image.size)
+    return secure_url
+
+def fits_platform(image: TelegramMedia, limits: dict):
+    """Checks a photo against a platform's limits using Telegram's dimensions, without decoding it."""
+    ratio = image.width / image.height
+    return (
+        limits.get("min_ratio", 0) <= ratio <= limits.get("max_ratio", math.inf)
+        and max(image.width, image.height) <= limits.get("max_side", math.inf)
+        and min(image.width, image.height) >= limits.get("min_side", 0)
+        and image.size <= limits.get("max_bytes", math.inf)
+    )
+
+def fit_aspect_ratio(img: Image.Image, min_ratio: float = None, max_ratio: float = None):
+    """Pads (or crops, see IMAGE_FIT_MODE) an image to the nearest ratio within the limits."""
+    width, height = img.size
+    if min_ratio and width / height < min_ratio:
+        # Too tall: widen the canvas or trim the top and bottom
+        if IMAGE_FIT_MODE == "crop":
+            new_height = math.floor(width / min_ratio)
+            top = (height - new_height) // 2
+            return img.crop((0, top, width, top + new_height))
+        size = (math.ceil(height * min_ratio), height)
+    elif max_ratio and width / height > max_ratio:
+        # Too wide: heighten the canvas or trim the sides
+        if IMAGE_FIT_MODE == "crop":
+            new_width = math.floor(height * max_ratio)
+            left = (width - new_width) // 2
+            return img.crop((left, 0, left + new_width, height))
+        size = (width, math.ceil(width / max_ratio))
+    else:
+        return img
+    canvas = Image.new("RGB", size, IMAGE_PAD_COLOR)
+    canvas.paste(img, ((size[0] - width) // 2, (size[1] - height) // 2))
+    return canvas
+
+def normalize_image_sync(data: bytes, limits: dict):
+    """Re-encodes a photo as a JPEG within a platform's limits. Runs in the image process pool.
+
+    The photo is scaled into the allowed side lengths, fitted to the allowed
+    aspect ratio and saved as a progressive JPEG without EXIF or other
+    metadata. Quality (and finally size) is lowered until it is under the
+    byte limit. Returns (jpeg bytes, width, height, SHA-256 of the bytes).
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        img = original.convert("RGB")
+    max_side = limits.get("max_side")
+    if max_side and max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+    min_side = limits.get("min_side")
+    if min_side and min(img.size) < min_side:
+        scale = min_side / min(img.size)
+        img = img.resize((math.ceil(img.width * scale), math.ceil(img.height * scale)), Image.LANCZOS)
+    img = fit_aspect_ratio(img, limits.get("min_ratio"), limits.get("max_ratio"))
+
+    max_bytes = limits.get("max_bytes", math.inf)
+    quality = limits.get("quality", 90)
+    while True:
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=quality, optimize=True, progressive=True)
+        if buffer.tell() <= max_bytes:
+            jpeg = buffer.getvalue()
+            return jpeg, img.width, img.height, hashlib.sha256(jpeg).hexdigest()
+        if quality > 60:
+            quality -= 10
+        else:
+            img = img.resize((int(img.width * 0.8), int(img.height * 0.8)), Image.LANCZOS)
+
+async def platform_rendition(image: TelegramMedia, platform: str):
+    """Returns the smallest version of the photo that `platform` accepts.
+
+    The platform's encode is made once in the image process pool and cached
+    by content hash. The original is returned instead when it fits the
+    platform and the encode would not be smaller.
+    """
+    limits = PLATFORM_IMAGE_LIMITS.get(platform)
+    fits = not limits or fits_platform(image, limits)
+    if not limits or (fits and not OPTIMIZE_RENDITIONS):
+        return image
+    key = (await image.sha256(), platform)
+    if key in rendition_cache:
+        rendition_cache.move_to_end(key)
+        rendition = rendition_cache[key]
+    else:
+        data, width, height, digest = await run_in_process("image", normalize_image_sync, image.read(), limits)
+        rendition = None
+        if not fits or len(data) < image.size:
+            rendition = TelegramMedia.from_bytes(f"{image.file_id}_{platform}", data, width, height, digest)
+            logger.info(
+                "🖼️ %s rendition of image %s…: %dx%d, %d KB -> %dx%d, %d KB.", platform, key[0][:12],
+                image.width, image.height, image.size // 1024, width, height, len(data) // 1024
+            )
+        rendition_cache[key] = rendition
+        while len(rendition_cache) > RENDITION_CACHE_SIZE:
+            rendition_cache.popitem(last=False)
+    rendition_stats["original_bytes"] += image.size
+    rendition_stats["rendition_bytes"] += (rendition or image).size
+    return rendition or image
+
+def rendition_summary():
+    original, sent = rendition_stats["original_bytes"], rendition_stats["rendition_bytes"]
+    saved = f"{100 * (original - sent) / original:.0f}%" if original else "n/a"
+    return f"Image renditions: {len(rendition_cache)} cached, {saved} fewer bytes uploaded than the originals"
+
+class PhotoPipeline:
+    """The download, renditions and uploads of one photo, each started at most once.
+
+    Every step is a task that later steps and the posting code await, so work
+    started early (see start_speculative_uploads) is simply picked up when the
+    album is posted.
+    """
+
+    def __init__(self, photo: telegram.PhotoSize, bot_instance: telegram.Bot):
+        self.photo = photo
+        self.bot_instance = bot_instance
+        self.created_at = time.monotonic()
+        self._tasks = {}
+
+    def _task(self, key, start):
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(start())
+        return task
+
+    def download(self):
+        """Downloads the photo into memory."""
+        return self._task("download", lambda: TelegramMedia.download(self.photo, self.bot_instance))
+
+    def rendition(self, platform: str):
+        async def render():
+            return await platform_rendition(await self.download(), platform)
+        return self._task(("rendition", platform), render)
+
+    def cloudinary_url(self, platform: str):
+        """Uploads the platform's rendition to Cloudinary; resolves to its URL or None."""
+        async def upload():
+            return await upload_image_to_cloudinary(await self.rendition(platform))
+        return self._task(("cloudinary", platform), upload)
+
+    def twitter_media_id(self):
+        """Uploads the Twitter rendition in chunks; resolves to its media ID."""
+        async def upload():
+            _, api_v1 = get_twitter_clients()
+            return await upload_twitter_image_with_retries(api_v1, await self.rendition("twitter"))
+        return self._task("twitter", upload)
+
+    async def close(self):
+        """Cancels unfinished steps and frees the downloaded photo."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        download = self._tasks.get("download")
+        if download and not download.cancelled() and download.exception() is None:
+            download.result().close()
+
+def start_speculative_uploads(message: telegram.Message, bot_instance: telegram.Bot):
+    """Starts uploading an album item while the rest of the album is still arriving.
+
+    Twitter only gets its rendition prepared: whether the album fits in one
+    tweet (4 photos) is only known once it is sealed, so its media upload,
+    which costs API quota, waits until then.
+    """
+    if not (SPECULATIVE_UPLOADS and message.photo) or message.from_user.id not in AUTHORIZED_USER_IDS:
+        return
+    photo = message.photo[-1]
+    pipeline = speculative_pipelines.get(photo.file_id)
+    if pipeline is None:
+        pipeline = speculative_pipelines[photo.file_id] = PhotoPipeline(photo, bot_instance)
+    if CLOUDINARY_CLOUD_NAME:
+        if FB_PAGE_ID and FB_PAGE_ACCESS_TOKEN:
+            pipeline.cloudinary_url("facebook")
+        if IG_ACCOUNT_ID and IG_ACCESS_TOKEN:
+            pipeline.cloudinary_url("instagram")
+    if twitter_configured() and len(media_group_messages[message.media_group_id]) <= 4:
+        pipeline.rendition("twitter")
+
+def claim_photo_pipeline(photo: telegram.PhotoSize, bot_instance: telegram.Bot):
+    """Returns the photo's early-started pipeline, or a fresh one."""
+    return speculative_pipelines.pop(photo.file_id, None) or PhotoPipeline(photo, bot_instance)
+
+def discard_speculative_uploads(file_ids: list = ()):
+    """Drops the early uploads of the given photos and of any left unclaimed for too long."""
+    cutoff = time.monotonic() - SPECULATIVE_TTL_SECONDS
+    stale = [fid for fid, pipeline in speculative_pipelines.items() if pipeline.created_at < cutoff]
+    for file_id in {*file_ids, *stale}:
+        pipeline = speculative_pipelines.pop(file_id, None)
+        if pipeline:
+            asyncio.ensure_future(pipeline.close())
+
+async def process_media_group(messages, bot_instance, caption, job: dict):
+    """Posts one or more photos, running the work as a small dependency graph.
+
+    Every download (into memory) starts at once. As soon as an image has
+    arrived, each platform's rendition of it is encoded in parallel (see
+    platform_rendition) and uploaded: the Facebook and Instagram ones to
+    Cloudinary, where identical files are only uploaded once, and the Twitter
+    one in chunks once Twitter's rate governor lets the post go ahead. Album
+    items usually started most of this while the album was still arriving.
+    Telegram reposts by file_id straight away and every other
+    platform posts once its uploads exist, so the album takes as long as its
+    slowest path instead of the sum of every step.
+    """
+    photo_messages = [msg for msg in sorted(messages, key=lambda m: m.message_id) if msg.photo]
+    platforms = pending_platforms(job)
+    if not photo_messages or not platforms:
+        return {}
+
+    # Telegram alone never needs the bytes unless its file_id repost fails
+    pipelines = [claim_photo_pipeline(msg.photo[-1], bot_instance) for msg in photo_messages]
+
+    def gather_steps(step):
+        return asyncio.gather(*(step(pipeline) for pipeline in pipelines))
+
+    rendered = {platform for platform in platforms if platform in PLATFORM_IMAGE_LIMITS}
+    twitter_skip_reason = None
+    if not twitter_configured():
+        twitter_skip_reason = "Twitter API v1.1 credentials are not set"
+    elif len(photo_messages) > 4:
+        twitter_skip_reason = "Twitter only supports up to 4 images"
+    if twitter_skip_reason:
+        rendered.discard("twitter")
+    if not CLOUDINARY_CLOUD_NAME:
+        rendered -= {"facebook", "instagram"} # Both post by Cloudinary URL
+    saved_twitter_media = saved_platform_media(job, "twitter", TWITTER_MEDIA_ID_TTL_SECONDS)
+    for pipeline in pipelines:
+        for platform in rendered:
+            if platform == "twitter":
+                # The media upload costs Twitter quota, so post_twitter only
+                # starts it once fan_out has reserved a rate token
+                if saved_twitter_media is None:
+                    pipeline.rendition("twitter")
+            else:
+                pipeline.cloudinary_url(platform)
+
+    async def post_twitter():
+        if twitter_skip_reason:
+            logger.warning("%s. Skipping Twitter post.", twitter_skip_reason)
+            return None
+        media_ids = saved_twitter_media
+        if media_ids is None:
+            try:
+                media_ids = list(await gather_steps(PhotoPipeline.twitter_media_id))
+            except Exception as e:
+                logger.warning("⚠️ Twitter upload failed (%s). Trying once more.", e)
+                images = await gather_steps(lambda pipeline: pipeline.rendition("twitter"))
+                return await post_to_twitter(caption, list(images))
+            # If the tweet fails, the next attempt of the job only has to create it
+            save_platform_media(job, "twitter", media_ids)
+        return await post_to_twitter(caption, media_ids=media_ids)
+
+    async def with_urls(platform, post):
+        cloudinary_urls = await gather_steps(lambda pipeline: pipeline.cloudinary_url(platform))
+        if not all(cloudinary_urls):
+            raise PostError("Not every image could be uploaded to Cloudinary.")
+        return await post(list(cloudinary_urls))
+
+    async def post_to_facebook(cloudinary_urls):
+        # Conditional logic for Facebook single vs. album post
+        if len(cloudinary_urls) > 1:
+            return await post_album_to_facebook_page(caption, cloudinary_urls)
+        return await post_to_facebook_page(caption, cloudinary_urls[0])
+
+    posting_tasks = {}
+    if "twitter" in platforms:
+        posting_tasks["twitter"] = post_twitter()
+    if "telegram" in platforms:
+        file_ids = [msg.photo[-1].file_id for msg in photo_messages]
+        posting_tasks["telegram"] = post_to_telegram_channel(
+            file_ids, caption, bot_instance, get_images=lambda: gather_steps(PhotoPipeline.download)
+        )
+    if "facebook" in rendered:
+        posting_tasks["facebook"] = with_urls("facebook", post_to_facebook)
+    if "instagram" in rendered:
+        posting_tasks["instagram"] = with_urls("instagram", lambda urls: post_to_instagram_feed(urls, caption))
+
+    try:
+        return await fan_out(posting_tasks, job)
+    finally:
+        await asyncio.gather(*(pipeline.close() for pipeline in pipelines))
+
+async def handle_telegram_message(update: telegram.Update, bot_instance: telegram.Bot, job: dict):
+    """Posts a single (non-album) message. Returns the per-platform results, or None if nothing was posted."""
+    if not update.message: return None
+    message = update.message
+
+    # --- NEW SECURITY CHECK ---
+    # Get the sender's user ID and check if it's in the authorized list
+    sender_id = message.from_user.id
+    if sender_id not in AUTHORIZED_USER_IDS:
+        logger.info("🚫 Unauthorized user tried to use the bot. User ID: %d", sender_id)
+        await message.reply_text("❌ You are not authorized to use this bot.")
+        return None
+
+    if message.text and message.text.split()[0] in ("/status", "/stats"):
+        await message.reply_text(bot_status_report())
+        return None
+
+    caption = message.caption or message.text or ""
+    platforms = pending_platforms(job)
+    posting_tasks = {}
+
+    if message.photo:
+        # A single photo goes through the same stages as an album of one
+        return await process_media_group([message], bot_instance, caption, job)
+
+    elif message.text:
+        if "twitter" in platforms:
+            posting_tasks["twitter"] = post_to_twitter(message.text)
+        if "telegram" in platforms:
+            posting_tasks["telegram"] = post_text_to_telegram_channel(message.text, bot_instance)
+        if "facebook" in platforms:
+            posting_tasks["facebook"] = post_to_facebook_page(message.text)
+
+    if not posting_tasks:
+        return None
+    return await fan_out(posting_tasks, job)
+
+def bot_status_report():
+    """Text for the /status command."""
+    return "\n".join([
+        "📊 Bot status",
+        media_cache_summary(),
+        rendition_summary(),
+        rate_governor_summary(),
+        executor_summary(),
+    ])
+
+async def handle_media_group(messages, bot_instance: telegram.Bot, job: dict):
+    """Checks who sent a completed media group and posts it if they are authorized."""
+    caption = next((msg.caption for msg in messages if msg.caption), "")
+    # --- SECURITY CHECK FOR MEDIA GROUPS ---
+    # Check if the first message in the group is from an authorized user
+    first_message = messages[0]
+    if first_message.from_user.id not in AUTHORIZED_USER_IDS:
+        logger.info("🚫 Unauthorized user attempted to send a media group. User ID: %d", first_message.from_user.id)
+        await first_message.reply_text("❌ You are not authorized to use this bot.")
+        return None
+    return await process_media_group(messages, bot_instance, caption, job)
+
+# --- Outbox Workers ---
+
+# The outcome of one platform post: status is "done", "failed", "skipped",
+# "deferred" or "unknown" (the publish call went out but no answer came back);
+# latency is seconds since the fan-out started.
+PostResult = collections.namedtuple("PostResult", ["platform", "status", "post_id", "latency", "error"])
+
+def describe_result(result: PostResult):
+    if result.status == "done":
+        return f"✅ {result.platform}: posted in {result.latency:.1f}s (ID {result.post_id})"
+    if result.status == "skipped":
+        return f"➖ {result.platform}: skipped"
+    if result.status == "deferred":
+        return f"⏳ {result.platform}: {result.error}, will post later"
+    if result.status == "unknown":
+        return f"❔ {result.platform}: {result.error[:200]}; check whether it was posted"
+    return f"❌ {result.platform}: failed after {result.latency:.1f}s: {result.error[:200]}"
+
+class PostProgress:
+    """One status reply to the sender, edited as each platform finishes."""
+
+    def __init__(self, reply_to: telegram.Message):
+        self.reply_to = reply_to
+        self.message = None
+        self.lines = {} # platform -> line
+        self.footer = None
+        self._shown = None
+        self._lock = asyncio.Lock()
+
+    async def start(self, platforms):
+        for platform in platforms:
+            self.lines.setdefault(platform, f"⏳ {platform}: posting...")
+        await self._render()
+
+    async def report(self, result: PostResult):
+        self.lines[result.platform] = describe_result(result)
+        await self._render()
+
+    async def finish(self, text: str):
+        self.footer = text
+        await self._render()
+
+    async def _render(self):
+        async with self._lock:
+            text = "\n".join([*self.lines.values(), *([self.footer] if self.footer else [])])
+            if text == self._shown:
+                return
+            try:
+                if self.message is None:
+                    self.message = await self.reply_to.reply_text(text)
+                else:
+                    await self.message.edit_text(text)
+                self._shown = text
+            except Exception:
+                logger.exception("Could not update the status message:")
+
+def pending_platforms(job: dict):
+    """Returns the platforms a job still has to post to.
+
+    "unknown" ones are not retried blindly: the post may already be live.
+    """
+    return {p for p in PLATFORMS if job["platform_state"].get(p, {}).get("status") not in ("done", "skipped", "unknown")}
+
+async def fan_out(posting_tasks: dict, job: dict):
+    """Runs a job's platform posts concurrently and returns {platform: PostResult}.
+
+    Each outcome is saved, and shown in the job's "progress" message if it has
+    one, as soon as it is known. Each post first takes a token from its
+    platform's rate governor: short waits are slept off, longer ones defer
+    that platform to a later attempt. Posts still running after
+    FANOUT_DEADLINE_SECONDS are cancelled. They count as failed, so the
+    outbox retries them, unless their publish call already went out: those
+    (like publish calls that timed out) are "unknown" and not retried.
+    """
+    started = time.monotonic()
+    progress = job.get("progress")
+    settled = {} # platform -> PostResult, recorded as soon as it is known
+    publish_marks = {} # platform -> {"sent": bool}, see publish_attempt
+
+    async def post(platform, coro):
+        publish_marks[platform] = mark = {"sent": False}
+        publish_attempt.set(mark) # Only affects this platform's task
+        governor = rate_governor(platform)
+        wait = governor.reserve() if governor else 0.0
+        if wait > RATE_MAX_WAIT_SECONDS:
+            governor.cancel()
+            coro.close()
+            defer_platform(job, platform, wait)
+            return PostResult(platform, "deferred", None, 0.0, f"rate limited for {wait / 60:.0f} min")
+        if wait:
+            logger.info("⏳ Waiting %.0fs for the %s rate limit.", wait, platform)
+            await asyncio.sleep(wait)
+        try:
+            post_id = await coro
+        except Exception as e:
+            logger.exception("❌ Error posting to %s:", platform)
+            status = "unknown" if mark["sent"] and publish_outcome_unknown(e) else "failed"
+            return PostResult(platform, status, None, time.monotonic() - started, str(e) or repr(e))
+        if post_id is None:
+            if governor:
+                governor.cancel() # Skipped posts cost nothing
+            return PostResult(platform, "skipped", None, time.monotonic() - started, None)
+        return PostResult(platform, "done", str(post_id), time.monotonic() - started, None)
+
+    def settle(result):
+        # No await here, so the deadline cannot cancel a result half-recorded
+        settled[result.platform] = result
+        if result.status != "deferred":
+            record_platform_result(job, result.platform, result.status)
+        return result
+
+    async def run(platform, coro):
+        result = settle(await post(platform, coro))
+        if progress:
+            await progress.report(result)
+        return result
+
+    tasks = {platform: asyncio.ensure_future(run(platform, coro)) for platform, coro in posting_tasks.items()}
+    if not tasks:
+        return {}
+    if progress:
+        await progress.start(tasks)
+    _, late = await asyncio.wait(tasks.values(), timeout=max(0.0, FANOUT_DEADLINE_SECONDS - (time.monotonic() - started)))
+    for task in late:
+        task.cancel()
+    await asyncio.gather(*late, return_exceptions=True)
+
+    results = {}
+    for platform in tasks:
+        result = settled.get(platform)
+        if result is None:
+            # Cancelled at the deadline. A thread running the publish call
+            # cannot be stopped, so once it went out the post may still appear.
+            sent = publish_marks.get(platform, {}).get("sent", False)
+            logger.warning("⏰ %s did not finish within %ds.", platform, FANOUT_DEADLINE_SECONDS)
+            error = f"no answer within {FANOUT_DEADLINE_SECONDS}s" + (" after sending" if sent else "")
+            result = settle(PostResult(platform, "unknown" if sent else "failed", None, time.monotonic() - started, error))
+            if progress:
+                await progress.report(result)
+        results[platform] = result
+    return results
+
+async def run_outbox_job(job: dict, bot_instance: telegram.Bot):
+    """Runs one attempt of an outbox job and tells the sender how it went.
+
+    On the first attempt the sender gets one status message that is edited
+    as each platform finishes. Later attempts only report the final outcome.
+    """
+    if job["kind"] == "media_group":
+        messages = [telegram.Message.de_json(data, bot_instance) for data in job["payload"]["messages"]]
+        reply_to = min(messages, key=lambda m: m.message_id)
+        attempt = handle_media_group(messages, bot_instance, job)
+    else:
+        update = telegram.Update.de_json(job["payload"], bot_instance)
+        reply_to = update.message
+        attempt = handle_telegram_message(update, bot_instance, job)
+    if reply_to and not job["platform_state"]:
+        job["progress"] = PostProgress(reply_to)
+
+    error = None
+    try:
+        results = await attempt
+    except Exception as e:
+        logger.exception("Error running outbox job %s:", job["job_key"])
+        results, error = None, repr(e)
+
+    status, retry_in = finish_outbox_job(job, error)
+    failed = sorted(p for p, state in job["platform_state"].items() if state["status"] == "failed")
+    unknown = sorted(p for p, state in job["platform_state"].items() if state["status"] == "unknown")
+    if status == "done" and not results:
+        return
+
+    if status == "postponed":
+        # Tell the sender once per platform, not on every postponement
+        newly_deferred = sorted(
+            p for p, state in job["platform_state"].items() if state["status"] == "deferred" and state["deferrals"] == 1
+        )
+        if not newly_deferred:
+            return
+        text = f"⏳ Rate limit reached for {', '.join(newly_deferred)}. Posting there in about {retry_in / 60:.0f} min."
+    elif status == "done":
+        text = "✅ Post sent to the other platforms." if unknown else "✅ Post sent to all configured social media platforms!"
+    elif status == "pending":
+        if job["attempts"] > 1:
+            return
+        what = ", ".join(failed) if failed else "your post"
+        text = f"⚠️ Posting to {what} failed. Retrying in {retry_in:.0f}s..."
+    else:
+        what = ", ".join(failed) if failed else "your request"
+        text = f"❌ Failed to process {what} after {job['attempts']} attempts."
+    if unknown:
+        text += f"\n❔ No confirmation from {', '.join(unknown)} after sending, so it is not retried. Check there before posting again."
+    progress = job.get("progress")
+    if progress and progress.message:
+        await progress.finish(text)
+        return
+    try:
+        if reply_to:
+            await reply_to.reply_text(text)
+    except Exception:
+        logger.exception("Could not reply about outbox job %s:", job["job_key"])
+
+async def outbox_worker(worker_id: int, bot_instance: telegram.Bot):
+    """Claims due outbox jobs one after another and runs them."""
+    while True:
+        job = claim_outbox_job()
+        if job is None:
+            # Sleep until a new job is added or the next retry is due
+            outbox_wakeup.clear()
+            try:
+                await asyncio.wait_for(outbox_wakeup.wait(), timeout=next_outbox_job_delay())
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await run_outbox_job(job, bot_instance)
+        except Exception:
+            logger.exception("Error in outbox worker %d:", worker_id)
+
+def media_group_timeout():
+    """Returns how long a media group has to stay quiet before it is posted."""
+    if media_group_gap_estimate is None:
+        return media_group_timeout_ceiling
+    return min(media_group_timeout_ceiling, max(MEDIA_GROUP_MIN_TIMEOUT, media_group_gap_estimate * MEDIA_GROUP_GAP_FACTOR))
+
+def record_media_group_gap(gap: float, late: bool = False):
+    """Feeds an observed gap between album items into the timeout estimate.
+
+    Longer gaps are adopted immediately so the next album waits long enough,
+    shorter ones only pull the estimate down slowly. Gaps between items of
+    one get_updates batch only measure how fast the bot handled them, not how
+    far apart Telegram sent them, so they are ignored. A `late` gap (the item
+    came after its group was sealed) also raises the timeout's ceiling, up
+    to MEDIA_GROUP_MAX_TIMEOUT, so an album with the same timing fits.
+    """
+    global media_group_gap_estimate, media_group_timeout_ceiling
+    if gap < MEDIA_GROUP_BATCH_GAP:
+        return
+    if late and gap * MEDIA_GROUP_LATE_MARGIN > media_group_timeout_ceiling:
+        media_group_timeout_ceiling = min(MEDIA_GROUP_MAX_TIMEOUT, gap * MEDIA_GROUP_LATE_MARGIN)
+        logger.info("⏱️ Media groups now wait up to %.1fs for more items.", media_group_timeout_ceiling)
+    if media_group_gap_estimate is None or gap > media_group_gap_estimate:
+        media_group_gap_estimate = gap
+    else:
+        media_group_gap_estimate = 0.8 * media_group_gap_estimate + 0.2 * gap
+
+def buffer_media_group_message(update: telegram.Update, bot_instance: telegram.Bot):
+    """Adds an album item to its group, starts its uploads and (re)arms the timer that posts the group."""
+    message = update.message
+    group_id = message.media_group_id
+    now = time.monotonic()
+    if group_id in last_message_time:
+        record_media_group_gap(now - last_message_time[group_id])
+    elif group_id in flushed_media_groups:
+        # The group was already posted, so the timeout was too short for this album.
+        gap = now - flushed_media_groups.pop(group_id)
+        logger.warning("⏱️ Album item arrived %.2fs after the previous one, after its group was sealed.", gap)
+        record_media_group_gap(gap, late=True)
+
+    media_group_messages[group_id].append(message)
+    media_group_update_ids[group_id].append(update.update_id)
+    last_message_time[group_id] = now
+    start_speculative_uploads(message, bot_instance)
+
+    timer = media_group_timers.pop(group_id, None)
+    if timer:
+        timer.cancel()
+    media_group_timers[group_id] = asyncio.get_running_loop().call_later(
+        media_group_timeout(), flush_media_group, group_id
+    )
+
+def flush_media_group(group_id: str):
+    """Seals a media group that has gone quiet and writes it to the outbox."""
+    media_group_timers.pop(group_id, None)
+    messages = media_group_messages.pop(group_id, [])
+    update_ids = media_group_update_ids.pop(group_id, [])
+    flushed_media_groups[group_id] = last_message_time.pop(group_id, time.monotonic())
+
+    # Only remember sealed groups for a minute
+    cutoff = time.monotonic() - 60
+    for old_group_id in [gid for gid, seen in flushed_media_groups.items() if seen < cutoff]:
+        flushed_media_groups.pop(old_group_id, None)
+    discard_speculative_uploads()
+
+    if not messages:
+        return
+    if is_media_group_processed(group_id):
+        # These items arrived after their album was sealed. They join the
+        # album's job if no worker has started it, else they follow it up.
+        if attach_to_pending_job(f"album:{group_id}", messages, update_ids):
+            logger.info("📎 Added %d late item(s) to media group %s before it was posted.", len(messages), group_id)
+            return
+        logger.warning("📎 %d item(s) of media group %s arrived after it was posted. Posting them separately.", len(messages), group_id)
+        enqueue_outbox_job(
+            f"album:{group_id}:late:{update_ids[0]}", "media_group", {"messages": [m.to_dict() for m in messages]}, update_ids
+        )
+        if messages[0].from_user.id in AUTHORIZED_USER_IDS:
+            asyncio.ensure_future(reply_quietly(
+                messages[0], f"📎 {len(messages)} photo(s) arrived after the rest of the album was posted. Posting them as a follow-up."
+            ))
+        return
+    logger.info("📚 Media group %s complete with %d item(s).", group_id, len(messages))
+    enqueue_outbox_job(f"album:{group_id}", "media_group", {"messages": [m.to_dict() for m in messages]}, update_ids, group_id)
+
+async def reply_quietly(message: telegram.Message, text: str):
+    try:
+        await message.reply_text(text)
+    except Exception:
+        logger.exception("Could not reply to message %d:", message.message_id)
+
+def dispatch_update(update: telegram.Update, bot_instance: telegram.Bot):
+    """Routes an incoming update without waiting for it to be posted.
+
+    Album items are buffered until their group is complete; everything else is
+    written to the outbox straight away for the next free worker.
+    """
+    message = update.message
+    if message and message.media_group_id:
+        buffer_media_group_message(update, bot_instance)
+        return
+    enqueue_outbox_job(f"update:{update.update_id}", "message", update.to_dict(), [update.update_id])
+
+async def run_polling(bot_instance: telegram.Bot):
+    """Long-polls get_updates and dispatches every update."""
+    await bot_instance.delete_webhook()
+    update_id = load_update_offset()
+    logger.info("📡 Receiving updates by long polling from offset %d.", update_id)
+
+    while True:
+        try:
+            # get_updates already waits up to `timeout` seconds for new updates,
+            # so the loop goes straight back to Telegram after dispatching.
+            updates = await bot_instance.get_updates(offset=update_id, timeout=10)
+            # Only acknowledge updates (by moving the offset) once they are stored
+            new_updates = record_received_updates(updates)
+            if updates:
+                update_id = updates[-1].update_id + 1
+            for update in new_updates:
+                dispatch_update(update, bot_instance)
+        except telegram.error.NetworkError as e:
+            logger.error("Telegram Network Error: %s. Retrying in 5s...", e)
+            await asyncio.sleep(5)
+        except Exception:
+            logger.exception("Error in main loop. Retrying in 5s...")
+            await asyncio.sleep(5)
+
+async def write_webhook_response(writer: asyncio.StreamWriter, status: int, reason: str, keep_alive: bool):
+    connection = "keep-alive" if keep_alive else "close"
+    writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\nConnection: {connection}\r\n\r\n".encode("ascii"))
+    await writer.drain()
+
+async def handle_webhook_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                    bot_instance: telegram.Bot, webhook_path: str):
+    """Serves webhook requests from Telegram on one (keep-alive) connection.
+
+    Updates are written to the outbox before the response is sent, and posting
+    happens in the worker pool, so Telegram gets its 200 OK straight away.
+    """
+    try:
+        while True:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=60)
+            if not request_line:
+                return
+            parts = request_line.decode("latin-1").split()
+            if len(parts) != 3:
+                await write_webhook_response(writer, 400, "Bad Request", False)
+                return
+            method, path, version = parts
+
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=10)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            content_length = int(headers.get("content-length", "0"))
+            if content_length > WEBHOOK_MAX_BODY_BYTES:
+                await write_webhook_response(writer, 413, "Payload Too Large", False)
+                return
+            body = await asyncio.wait_for(reader.readexactly(content_length), timeout=10)
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+            if method != "POST" or path != webhook_path:
+                await write_webhook_response(writer, 404, "Not Found", keep_alive)
+            elif not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode(), TELEGRAM_WEBHOOK_SECRET.encode()):
+                logger.warning("🚫 Rejected webhook request with a missing or wrong secret token.")
+                await write_webhook_response(writer, 403, "Forbidden", keep_alive)
+            else:
+                try:
+                    update = telegram.Update.de_json(json.loads(body), bot_instance)
+                except ValueError:
+                    await write_webhook_response(writer, 400, "Bad Request", keep_alive)
+                else:
+                    for new_update in record_received_updates([update]):
+                        dispatch_update(new_update, bot_instance)
+                    await write_webhook_response(writer, 200, "OK", keep_alive)
+
+            if not keep_alive:
+                return
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    except Exception:
+        logger.exception("Error serving webhook request:")
+    finally:
+        writer.close()
+
+def webhook_ssl_context():
+    """Returns the TLS context for the webhook server, or None if a proxy terminates TLS."""
+    if not TELEGRAM_WEBHOOK_CERT:
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(TELEGRAM_WEBHOOK_CERT, TELEGRAM_WEBHOOK_KEY)
+    return context
+
+async def start_webhook_server(bot_instance: telegram.Bot, webhook_path: str):
+    """Starts the server that receives webhook updates, over HTTPS if a certificate is set."""
+    ssl_context = webhook_ssl_context()
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_webhook_connection(reader, writer, bot_instance, webhook_path),
+        host=TELEGRAM_WEBHOOK_LISTEN, port=TELEGRAM_WEBHOOK_PORT, ssl=ssl_context
+    )
+    logger.info(
+        "🌐 Webhook server listening on %s://%s:%d%s", "https" if ssl_context else "http",
+        TELEGRAM_WEBHOOK_LISTEN, TELEGRAM_WEBHOOK_PORT, webhook_path
+    )
+    if ssl_context is None:
+        logger.info("🔒 No TELEGRAM_WEBHOOK_CERT set; a TLS-terminating proxy must forward %s here.", TELEGRAM_WEBHOOK_URL)
+    return server
+
+async def run_webhook(bot_instance: telegram.Bot):
+    """Registers TELEGRAM_WEBHOOK_URL with Telegram and serves updates pushed to it."""
+    webhook_path = urlsplit(TELEGRAM_WEBHOOK_URL).path or "/"
+    server = await start_webhook_server(bot_instance, webhook_path)
+    async with server:
+        certificate = None
+        if TELEGRAM_WEBHOOK_CERT and TELEGRAM_WEBHOOK_SELF_SIGNED:
+            with open(TELEGRAM_WEBHOOK_CERT, "rb") as cert_file:
+                # Only the certificate blocks, in case the private key shares the file
+                certificate = b"".join(re.findall(rb"-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----\n?", cert_file.read(), re.S))
+        await bot_instance.set_webhook(
+            url=TELEGRAM_WEBHOOK_URL,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=["message"],
+            certificate=certificate
+        )
+        logger.info("📡 Receiving updates by webhook at %s", TELEGRAM_WEBHOOK_URL)
+        await server.serve_forever()
+
+async def main():
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("❌ TELEGRAM_BOT_TOKEN is not set. Exiting.")
+        return
+
+    global outbox_wakeup
+    bot = create_telegram_bot()
+    logger.info("🚀 Telegram Bot is running...")
+    open_state_db()
+    open_executors()
+    await open_http_clients(bot)
+    outbox_wakeup = asyncio.Event()
+
+    workers = [asyncio.create_task(outbox_worker(i, bot)) for i in range(MAX_CONCURRENT_UPDATES)]
+    logger.info("👷 Started %d outbox workers.", MAX_CONCURRENT_UPDATES)
+
+    # Finish whatever the previous run received but did not get to the outbox
+    pending_updates = load_pending_updates(bot)
+    if pending_updates:
+        logger.info("♻️ Resuming %d unfinished update(s) from the previous run.", len(pending_updates))
+    for update in pending_updates:
+        dispatch_update(update, bot)
+
+    try:
+        if TELEGRAM_WEBHOOK_URL:
+            await run_webhook(bot)
+        else:
+            await run_polling(bot)
+    finally:
+        for timer in media_group_timers.values():
+            timer.cancel()
+        await asyncio.gather(*(pipeline.close() for pipeline in speculative_pipelines.values()))
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await close_http_clients(bot)
+        shutdown_executors()
+        state_db.close()
+
+def run():
+    """Runs the bot until it is stopped."""
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Bot stopped by user.")
\ No newline at end of file
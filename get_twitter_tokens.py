@@ -4,6 +4,7 @@ import webbrowser
 from dotenv import load_dotenv
 import urllib.parse
 import time
+from twitter_oauth2 import TwitterTokenManager
 
 # Load environment variables
 load_dotenv()
@@ -65,6 +66,12 @@ def get_oauth2_tokens():
         print("\nIMPORTANT: Add these lines to your .env file (for your main bot script)!")
         print("------------------------------------------------------------------")
 
+        # The bots read the token file first, so they pick these up even before .env is updated
+        if refresh_token:
+            token_file = os.getenv("TWITTER_TOKEN_FILE", "twitter_tokens.json")
+            TwitterTokenManager(CLIENT_ID, CLIENT_SECRET, path=token_file).update(tokens)
+            print(f"Tokens also saved to {token_file}.")
+
     except Exception as e:
         print(f"\nError fetching tokens: {e}")
         print("Please ensure you pasted the full redirect URL and that your Client ID/Secret are correct.")
@@ -1,7 +1,6 @@
 import os
 import asyncio
 import logging
-import base64
 import time
 from dotenv import load_dotenv
 import httpx
@@ -26,11 +25,7 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
-# Twitter (V2 for posting, V1.1 for media upload)
-TWITTER_CLIENT_ID = os.getenv("TWITTER_CLIENT_ID")
-TWITTER_CLIENT_SECRET = os.getenv("TWITTER_CLIENT_SECRET")
-TWITTER_ACCESS_TOKEN = os.getenv("TWITTER_ACCESS_TOKEN")
-TWITTER_REFRESH_TOKEN = os.getenv("TWITTER_REFRESH_TOKEN")
+# Twitter (V2 for posting, V1.1 for media upload; both with the V1.1 user keys)
 TWITTER_API_KEY_V1 = os.getenv("TWITTER_API_KEY_V1")
 TWITTER_API_SECRET_V1 = os.getenv("TWITTER_API_SECRET_V1")
 TWITTER_ACCESS_TOKEN_V1 = os.getenv("TWITTER_ACCESS_TOKEN_V1")
@@ -72,42 +67,10 @@ MEDIA_GROUP_TIMEOUT = 2 # Seconds to wait for all messages in a group
 
 # --- Twitter Posting Functions ---
 
-async def refresh_twitter_token():
-    """Refreshes the Twitter API v2 bearer token using the refresh token."""
-    try:
-        async with httpx.AsyncClient() as client:
-            auth_header = base64.b64encode(f"{TWITTER_CLIENT_ID}:{TWITTER_CLIENT_SECRET}".encode()).decode()
-            response = await client.post(
-                "https://api.twitter.com/2/oauth2/token",
-                headers={"Authorization": f"Basic {auth_header}"},
-                data={
-                    "grant_type": "refresh_token",
-                    "refresh_token": TWITTER_REFRESH_TOKEN,
-                    "client_id": TWITTER_CLIENT_ID,
-                }
-            )
-            response.raise_for_status()
-            token_data = response.json()
-            new_access_token = token_data["access_token"]
-            new_refresh_token = token_data["refresh_token"]
-            os.environ["TWITTER_ACCESS_TOKEN"] = new_access_token
-            os.environ["TWITTER_REFRESH_TOKEN"] = new_refresh_token
-            logger.warning("🔑 Twitter tokens refreshed! PLEASE UPDATE YOUR .ENV FILE:")
-            logger.warning("TWITTER_ACCESS_TOKEN=%s", new_access_token)
-            logger.warning("TWITTER_REFRESH_TOKEN=%s", new_refresh_token)
-            return new_access_token
-    except httpx.HTTPStatusError as e:
-        logger.error("Failed to refresh Twitter token: %s - Response: %s", e.response.status_code, e.response.text)
-        return None
-    except Exception as e:
-        logger.error("Unexpected error while refreshing Twitter token: %s", e)
-        return None
-
 async def post_to_twitter(caption: str, image_paths: list = None):
     """Posts a text tweet or an image tweet (up to 4) to Twitter."""
     global twitter_v1_api
-    if not all([TWITTER_CLIENT_ID, TWITTER_CLIENT_SECRET, TWITTER_ACCESS_TOKEN, TWITTER_REFRESH_TOKEN, TWITTER_API_KEY_V1,
-                TWITTER_API_SECRET_V1, TWITTER_ACCESS_TOKEN_V1, TWITTER_ACCESS_TOKEN_SECRET_V1]):
+    if not all([TWITTER_API_KEY_V1, TWITTER_API_SECRET_V1, TWITTER_ACCESS_TOKEN_V1, TWITTER_ACCESS_TOKEN_SECRET_V1]):
         logger.error("❌ One or more Twitter API credentials are not set. Skipping Twitter post.")
         return
 
@@ -140,15 +103,7 @@ async def post_to_twitter(caption: str, image_paths: list = None):
         logger.info("✅ Successfully posted to Twitter! Tweet ID: %s", tweet_response.data['id'])
 
     except tweepy.HTTPException as e:
-        if e.response.status_code == 401:
-            logger.info("🔄 Twitter Access Token unauthorized. Attempting to refresh token...")
-            new_access_token = await refresh_twitter_token()
-            if new_access_token:
-                await post_to_twitter(caption, image_paths)
-            else:
-                logger.error("❌ Failed to refresh Twitter token. Please regenerate tokens.")
-        else:
-            logger.error("❌ Twitter post failed: %s - Response: %s", e.response.status_code, e.response.text)
+        logger.error("❌ Twitter post failed: %s - Response: %s", e.response.status_code, e.response.text)
     except Exception as e:
         logger.error("Unexpected error while posting to Twitter: %s", e)
 
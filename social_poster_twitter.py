@@ -3,9 +3,9 @@ import asyncio
 import logging
 from dotenv import load_dotenv
 import httpx
-import base64
 import tweepy  # Added tweepy import
 import telegram
+from twitter_oauth2 import TwitterTokenManager
 
 # Configure logging
 logging.basicConfig(
@@ -30,46 +30,32 @@ TWITTER_ACCESS_TOKEN_SECRET_V1 = os.getenv("TWITTER_ACCESS_TOKEN_SECRET_V1")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHANNEL_ID = os.getenv("TELEGRAM_CHANNEL_ID")
 
-async def refresh_twitter_token():
-    try:
-        async with httpx.AsyncClient() as client:
-            auth_header = base64.b64encode(f"{TWITTER_CLIENT_ID}:{TWITTER_CLIENT_SECRET}".encode()).decode()
-            response = await client.post(
-                "https://api.twitter.com/2/oauth2/token",
-                headers={"Authorization": f"Basic {auth_header}"},
-                data={
-                    "grant_type": "refresh_token",
-                    "refresh_token": TWITTER_REFRESH_TOKEN,
-                    "client_id": TWITTER_CLIENT_ID,
-                }
-            )
-            response.raise_for_status()
-            token_data = response.json()
-            new_access_token = token_data["access_token"]
-            new_refresh_token = token_data["refresh_token"]
-            os.environ["TWITTER_ACCESS_TOKEN"] = new_access_token
-            os.environ["TWITTER_REFRESH_TOKEN"] = new_refresh_token
-            logger.warning("🔑 Twitter tokens refreshed! PLEASE UPDATE YOUR .ENV FILE:")
-            logger.warning("TWITTER_ACCESS_TOKEN=%s", new_access_token)
-            logger.warning("TWITTER_REFRESH_TOKEN=%s", new_refresh_token)
-            return new_access_token
-    except httpx.HTTPStatusError as e:
-        logger.error("Failed to refresh Twitter token: %s - Response: %s", e.response.status_code, e.response.text)
-        return None
-    except Exception as e:
-        logger.error("Unexpected error while refreshing Twitter token: %s", e)
-        return None
+# OAuth 2.0 user tokens, refreshed ahead of expiry and persisted across restarts
+twitter_tokens = TwitterTokenManager(
+    TWITTER_CLIENT_ID, TWITTER_CLIENT_SECRET, TWITTER_ACCESS_TOKEN, TWITTER_REFRESH_TOKEN,
+    path=os.getenv("TWITTER_TOKEN_FILE", "twitter_tokens.json")
+)
+
+async def create_tweet(payload: dict, access_token: str):
+    async with httpx.AsyncClient() as client:
+        response = await client.post(
+            "https://api.twitter.com/2/tweets",
+            headers={"Authorization": f"Bearer {access_token}"},
+            json=payload
+        )
+        response.raise_for_status()
+        return response.json()['data']['id']
 
 async def post_to_twitter(caption: str, image_path: str = None):
     global twitter_v1_api
 
     logger.info("Twitter Env Vars Loaded: CLIENT_ID=%s, ACCESS_TOKEN=%s, REFRESH_TOKEN=%s, API_KEY_V1=%s",
                 TWITTER_CLIENT_ID,
-                "*" * len(TWITTER_ACCESS_TOKEN or ""),
-                "*" * len(TWITTER_REFRESH_TOKEN or ""),
+                "*" * len(twitter_tokens.tokens.get("access_token") or ""),
+                "*" * len(twitter_tokens.tokens.get("refresh_token") or ""),
                 TWITTER_API_KEY_V1)
 
-    if not all([TWITTER_CLIENT_ID, TWITTER_ACCESS_TOKEN, TWITTER_REFRESH_TOKEN,
+    if not all([TWITTER_CLIENT_ID, twitter_tokens.tokens.get("access_token"), twitter_tokens.configured,
                 TWITTER_API_KEY_V1, TWITTER_API_SECRET_V1, TWITTER_ACCESS_TOKEN_V1, TWITTER_ACCESS_TOKEN_SECRET_V1]):
         logger.error("❌ One or more Twitter API credentials are not set. Please check your .env file.")
         return
@@ -96,50 +82,27 @@ async def post_to_twitter(caption: str, image_path: str = None):
             media_ids.append(media.media_id_string)
             logger.info("✅ Image uploaded to Twitter media. Media ID: %s", media.media_id_string)
 
-        async with httpx.AsyncClient() as client:
-            logger.info("🐦 Attempting to post to Twitter with caption: '%s' and media_ids: %s", caption, media_ids)
-            payload = {"text": caption}
-            if media_ids:
-                payload["media"] = {"media_ids": media_ids}
-            response = await client.post(
-                "https://api.twitter.com/2/tweets",
-                headers={"Authorization": f"Bearer {TWITTER_ACCESS_TOKEN}"},
-                json=payload
-            )
-            response.raise_for_status()
-            logger.info("✅ Successfully posted to Twitter! Tweet ID: %s", response.json()['data']['id'])
-
-    except httpx.HTTPStatusError as e:
-        if e.response.status_code == 401:
+        logger.info("🐦 Attempting to post to Twitter with caption: '%s' and media_ids: %s", caption, media_ids)
+        payload = {"text": caption}
+        if media_ids:
+            payload["media"] = {"media_ids": media_ids}
+        # The token manager refreshes ahead of expiry, so this token is normally valid
+        access_token = await twitter_tokens.get_access_token()
+        try:
+            tweet_id = await create_tweet(payload, access_token)
+        except httpx.HTTPStatusError as e:
+            # The token was revoked early: refresh once and reuse the uploaded media
+            if e.response.status_code != 401:
+                raise
             logger.info("🔄 Twitter Access Token unauthorized. Attempting to refresh token...")
-            new_access_token = await refresh_twitter_token()
-            if new_access_token:
-                try:
-                    media_ids = []
-                    if image_path and os.path.exists(image_path):
-                        logger.info("🐦 Retrying image upload to Twitter media endpoint: %s", image_path)
-                        media = await asyncio.to_thread(twitter_v1_api.media_upload, filename=image_path)
-                        media_ids.append(media.media_id_string)
-                        logger.info("✅ Image uploaded to Twitter media on retry. Media ID: %s", media.media_id_string)
-
-                    async with httpx.AsyncClient() as client:
-                        logger.info("🐦 Retrying Twitter post with new token...")
-                        payload = {"text": caption}
-                        if media_ids:
-                            payload["media"] = {"media_ids": media_ids}
-                        response = await client.post(
-                            "https://api.twitter.com/2/tweets",
-                            headers={"Authorization": f"Bearer {new_access_token}"},
-                            json=payload
-                        )
-                        response.raise_for_status()
-                        logger.info("✅ Successfully posted to Twitter after token refresh! Tweet ID: %s", response.json()['data']['id'])
-                except httpx.HTTPStatusError as retry_e:
-                    logger.error("❌ Twitter post failed even after token refresh: %s - Response: %s", retry_e.response.status_code, retry_e.response.text)
-            else:
+            if not await twitter_tokens.refresh(stale_token=access_token):
                 logger.error("❌ Failed to refresh Twitter token. Please regenerate tokens in Twitter Developer Portal.")
-        else:
-            logger.error("❌ Twitter post failed: %s - Response: %s", e.response.status_code, e.response.text)
+                return
+            tweet_id = await create_tweet(payload, twitter_tokens.tokens["access_token"])
+        logger.info("✅ Successfully posted to Twitter! Tweet ID: %s", tweet_id)
+
+    except httpx.HTTPStatusError as e:
+        logger.error("❌ Twitter post failed: %s - Response: %s", e.response.status_code, e.response.text)
     except Exception as e:
         logger.error("Unexpected error while posting to Twitter: %s", e)
 
@@ -177,6 +140,7 @@ async def handle_telegram_message(update):
 async def main():
     bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
     update_id = 0  # Initialize with 0 to avoid NoneType comparison
+    twitter_tokens.start()
 
     while True:
         try:
@@ -0,0 +1,159 @@
+"""Keeps the Twitter OAuth 2.0 user tokens fresh for the posting scripts.
+
+The tokens live in a local JSON file (TWITTER_TOKEN_FILE) together with their
+expiry, so a restart picks up the latest rotated refresh token instead of the
+stale one in .env. They are refreshed in the background shortly before they
+expire, and concurrent callers share a single refresh. Twitter rotates the
+refresh token on every use, so before refreshing the manager re-reads the file
+and adopts tokens another process has already rotated.
+"""
+import os
+import json
+import time
+import base64
+import asyncio
+import logging
+import httpx
+
+logger = logging.getLogger(__name__)
+
+TWITTER_TOKEN_URL = "https://api.twitter.com/2/oauth2/token"
+DEFAULT_TOKEN_FILE = "twitter_tokens.json"
+REFRESH_MARGIN = 600 # Seconds before expiry at which the tokens are refreshed
+REFRESH_RETRY_DELAY = 60 # Seconds between background attempts after a failed refresh
+
+class TwitterTokenManager:
+    def __init__(self, client_id, client_secret=None, access_token=None, refresh_token=None,
+                 path=DEFAULT_TOKEN_FILE, refresh_margin=REFRESH_MARGIN):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.path = path
+        self.refresh_margin = refresh_margin
+        # Tokens from .env are of unknown age, so they count as expired and
+        # are refreshed before their first use
+        self.tokens = self._load() or {"access_token": access_token, "refresh_token": refresh_token, "expires_at": 0}
+        self.rejected_refresh_token = None # Set when Twitter answers invalid_grant; it is not sent again
+        self._lock = None
+        self._task = None
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                tokens = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("⚠️ Could not read Twitter tokens from %s: %s", self.path, e)
+            return None
+        if not tokens.get("refresh_token"):
+            return None
+        return tokens
+
+    def _adopt_saved(self):
+        """Switches to the tokens in the file if another process rotated them since we last saw them."""
+        saved = self._load()
+        if not saved or saved.get("refresh_token") == self.tokens.get("refresh_token"):
+            return False
+        if saved.get("expires_at", 0) < self.tokens.get("expires_at", 0):
+            return False
+        self.tokens = saved
+        logger.info("🔑 Loaded newer Twitter tokens from %s.", self.path)
+        return True
+
+    def _save(self):
+        # Write to a private temp file first so a crash never leaves a half-written store
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.tokens, f)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def configured(self):
+        return bool(self.client_id and self.tokens.get("refresh_token"))
+
+    def expires_in(self):
+        return self.tokens.get("expires_at", 0) - time.time()
+
+    def update(self, token_data: dict):
+        """Stores a token endpoint response (access token, rotated refresh token, expiry)."""
+        expires_at = token_data.get("expires_at") or time.time() + token_data.get("expires_in", 7200)
+        self.tokens = {
+            "access_token": token_data["access_token"],
+            "refresh_token": token_data.get("refresh_token") or self.tokens.get("refresh_token"),
+            "expires_at": expires_at,
+        }
+        try:
+            self._save()
+        except OSError:
+            logger.exception("❌ Could not save Twitter tokens to %s:", self.path)
+
+    async def get_access_token(self):
+        """Returns the access token, refreshing it first if it is about to expire."""
+        if self.configured and self.expires_in() <= self.refresh_margin:
+            await self.refresh()
+        return self.tokens.get("access_token")
+
+    async def refresh(self, stale_token=None):
+        """Refreshes the tokens. Returns True if a valid access token is available.
+
+        Callers that arrive while a refresh is running wait for it instead of
+        starting their own. With `stale_token` (a token a request was just
+        rejected with) the tokens are refreshed even if they have not expired,
+        unless another caller or process has already replaced that token.
+        A refresh token Twitter rejected as invalid_grant is never sent again;
+        only new tokens in the file (e.g. from get_twitter_tokens.py) help then.
+        """
+        if not self.configured:
+            return False
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._adopt_saved()
+            if stale_token is not None:
+                if self.tokens.get("access_token") != stale_token:
+                    return True
+            elif self.expires_in() > self.refresh_margin:
+                return True
+            if self.tokens["refresh_token"] == self.rejected_refresh_token:
+                return False
+
+            auth_header = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
+            try:
+                async with httpx.AsyncClient(timeout=30.0) as client:
+                    response = await client.post(
+                        TWITTER_TOKEN_URL,
+                        headers={"Authorization": f"Basic {auth_header}"},
+                        data={
+                            "grant_type": "refresh_token",
+                            "refresh_token": self.tokens["refresh_token"],
+                            "client_id": self.client_id,
+                        }
+                    )
+                response.raise_for_status()
+                self.update(response.json())
+            except httpx.HTTPStatusError as e:
+                logger.error("Failed to refresh Twitter token: %s - Response: %s", e.response.status_code, e.response.text)
+                if e.response.status_code == 400 and "invalid_grant" in e.response.text:
+                    self.rejected_refresh_token = self.tokens["refresh_token"]
+                    logger.error("❌ Twitter rejected the refresh token. Run get_twitter_tokens.py to issue new ones.")
+                return False
+            except Exception as e:
+                logger.error("Unexpected error while refreshing Twitter token: %s", e)
+                return False
+            logger.info("🔑 Twitter tokens refreshed. Valid for %.0f min.", self.expires_in() / 60)
+            return True
+
+    def start(self):
+        """Starts refreshing the tokens in the background ahead of their expiry."""
+        if self.configured and self._task is None:
+            self._task = asyncio.create_task(self._keep_fresh())
+
+    async def _keep_fresh(self):
+        # After an invalid_grant this only re-reads the token file, waiting for new tokens
+        while True:
+            delay = self.expires_in() - self.refresh_margin
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if not await self.refresh():
+                await asyncio.sleep(REFRESH_RETRY_DELAY)